@@ -3,8 +3,11 @@ Synthesise a QA module into the B100 FPGA.
 """
 
 import os
+import errno
 import shutil
 import subprocess
+import tempfile
+import hashlib
 
 
 from jinja2 import Environment, FileSystemLoader
@@ -14,9 +17,14 @@ from fpga_sdrlib.config import uhddir, miscdir, fpgaimage_fn
 
 b100dir = os.path.join(uhddir, 'fpga', 'usrp2', 'top', 'B100')
 custom_src_dir = os.path.join(config.verilogdir, 'uhd')
+# Previously synthesised images are kept here, indexed by image_key.
+image_store_dir = os.path.join(config.builddir, 'b100_images')
+# The command used to run the Xilinx build.  It is run in b100dir with
+# the arguments '-f <makefile>'.
+make_command = ['make']
 
-def set_image(fn):
-    shutil.copyfile(fn, fpgaimage_fn)
+def set_image(fn, target=fpgaimage_fn):
+    shutil.copyfile(fn, target)
 
 def make_defines_file(builddir, defines):
     fn = os.path.join(builddir, 'global_defines.vh')
@@ -72,17 +80,83 @@ def make_make(name, builddir, inputfiles, defines):
                                 ))
     f_out.close()
 
-def synthesise(name, builddir):
+def image_key(inputfiles, defines):
+    """
+    A hash of everything that goes into synthesising an image.
+
+    Args:
+        inputfiles: The final verilog files (with defines prefixed).
+        defines: The defines used to make global_defines.vh.
+    """
+    h = hashlib.sha1()
+    h.update(make_defines_prefix(defines))
+    f = open(os.path.join(miscdir, 'Make.B100_qa.t'), 'rb')
+    h.update(f.read())
+    f.close()
+    for fn in inputfiles:
+        h.update(os.path.basename(fn))
+        f = open(fn, 'rb')
+        h.update(f.read())
+        f.close()
+    return h.hexdigest()
+
+def stored_image(key):
+    """
+    Returns the filename of a stored image or None if there is not one.
+    """
+    image_fn = os.path.join(image_store_dir, key, 'B100.bin')
+    if os.path.exists(image_fn):
+        return image_fn
+    return None
+
+def store_file(src_fn, store_dir, bn):
+    """
+    Copy a file into the store through a temporary file that is then
+    renamed so that a partly copied file is never seen.
+    """
+    fd, tmp_fn = tempfile.mkstemp(dir=store_dir, prefix='.tmp-')
+    os.close(fd)
+    try:
+        shutil.copyfile(src_fn, tmp_fn)
+        os.rename(tmp_fn, os.path.join(store_dir, bn))
+    finally:
+        if os.path.exists(tmp_fn):
+            os.remove(tmp_fn)
+
+def store_image(key, image_fn, logfile_fn):
+    """
+    Keep a synthesised image and its synthesis log in the image store.
+
+    The image is stored last since stored_image only looks for it.
+    """
+    store_dir = os.path.join(image_store_dir, key)
+    try:
+        os.makedirs(store_dir)
+    except OSError, e:
+        # Another process may have just made it.
+        if e.errno != errno.EEXIST:
+            raise
+    store_file(logfile_fn, store_dir, 'synthesis.log')
+    store_file(image_fn, store_dir, 'B100.bin')
+    return os.path.join(store_dir, 'B100.bin')
+
+def synthesise(name, builddir, command=None):
+    """
+    Synthesise an image using the makefile created by make_make.
+
+    Args:
+        command: The command to run the makefile with (defaults to
+            make_command).
+    """
+    if command is None:
+        command = make_command
     output_dir = os.path.join(builddir, 'build-B100_{name}'.format(name=name))
-    # Synthesise
-    currentdir = os.getcwd()
-    os.chdir(b100dir)
     if os.path.exists(output_dir):
         shutil.rmtree(output_dir)
     make_fn = os.path.join(builddir, 'Make.B100_{0}'.format(name))
     logfile_fn = os.path.join(builddir, 'Make.B100_{0}.log'.format(name))
     logfile = open(logfile_fn, 'w')
-    p = subprocess.Popen(['make', '-f', make_fn],
+    p = subprocess.Popen(list(command) + ['-f', make_fn], cwd=b100dir,
                          stdout=logfile, stderr=logfile)
     p.wait()
     logfile.flush()
@@ -91,10 +165,7 @@ def synthesise(name, builddir):
     # All constraints were met
     f = open(logfile_fn, 'r')
     lines = f.readlines()
-    lastline = lines[-2]
-    if lastline != 'All constraints were met.\n':
-        raise StandardError("Synthesis failed: see {0}".format(logfile_fn))
     f.close()
-    os.chdir(currentdir)
+    if len(lines) < 2 or lines[-2] != 'All constraints were met.\n':
+        raise StandardError("Synthesis failed: see {0}".format(logfile_fn))
     return os.path.join(output_dir, 'B100.bin')
-
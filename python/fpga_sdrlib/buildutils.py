@@ -1,7 +1,13 @@
 import shutil
 import os
+import errno
+import tempfile
 import logging
 import filecmp
+import hashlib
+import subprocess
+import multiprocessing
+import json
 
 from fpga_sdrlib import config
 from fpga_sdrlib import message, uhd, flow, flter, fpgamath, fft
@@ -9,7 +15,49 @@ from fpga_sdrlib import b100
 
 logger = logging.getLogger(__name__)
 
-def make_define_string(defines):
+# Compiled icarus executables are stored here named by the hash of
+# everything that went into compiling them.
+icarus_cachedir = os.path.join(config.builddir, 'icarus_cache')
+# generate_icarus_executables copies the input files of each build here
+# (in a directory starting with the build hash) until they are compiled.
+icarus_inputsdir = os.path.join(config.builddir, 'icarus_inputs')
+# How often generate_icarus_executable reused a cached executable.
+icarus_cache_stats = {'hits': 0, 'misses': 0}
+
+_iverilog_version = None
+
+def iverilog_version():
+    """
+    Returns the version line reported by iverilog.
+    """
+    global _iverilog_version
+    if _iverilog_version is None:
+        try:
+            p = subprocess.Popen(['iverilog', '-V'], stdout=subprocess.PIPE,
+                                 stderr=subprocess.STDOUT)
+            output = p.communicate()[0]
+            lines = output.splitlines()
+            _iverilog_version = lines[0] if lines else ''
+        except OSError:
+            _iverilog_version = 'unknown'
+    return _iverilog_version
+
+def icarus_build_hash(inputfiles, defines):
+    """
+    Hash the contents of the input files, the defines and the iverilog
+    version.  Executables with the same hash are identical.
+    """
+    h = hashlib.sha1()
+    h.update(iverilog_version())
+    h.update(repr(sorted(defines.items())))
+    for fn in inputfiles:
+        h.update(os.path.basename(fn))
+        f = open(fn, 'rb')
+        h.update(f.read())
+        f.close()
+    return h.hexdigest()
+
+def make_define_args(defines):
     definestrs = []
     for k, v in defines.items():
         if v is True or v is False:
@@ -17,35 +65,26 @@ def make_define_string(defines):
                 definestrs.append("-D" + k)
         else:
             definestrs.append("-D{0}={1}".format(k, v))
-    return ' '.join(definestrs)
-
-def generate_block(package, filename, extraargs={}, included_dependencies=set(),
-                   include_filenames=[]):
-    included_dependencies.add((package, filename))
-    dependencies, generating_function, args = blocks[package][filename]
-    if dependencies is None:
-        dependencies = []
-    include_filename, dep_extraargs = generating_function(
-        package, filename, dependencies, extraargs, **args)
-    include_filenames.append(include_filename)
-    if dependencies is None:
-        dependencies = []
-    if args is None:
-        args = {}
-    for d in dependencies:
-        bits = d.split('/')
-        if len(bits) == 1:
-            pck = package
-            fn = bits[0]
-        else:
-            pck = bits[0]
-            fn = bits[1]
-        if d in dep_extraargs:
-            extraargs = dep_extraargs[d]
-        else:
-            extraargs = {}
-        if (pck, fn) not in included_dependencies:
-            generate_block(pck, fn, extraargs, included_dependencies, include_filenames)
+    return definestrs
+
+def make_define_string(defines):
+    return ' '.join(make_define_args(defines))
+
+def generate_block(package, filename, extraargs={}, included_dependencies=None,
+                   include_filenames=None):
+    """
+    Generate a block and its dependencies.
+
+    Blocks in `included_dependencies` are not generated again.  The
+    generated filenames are appended to `include_filenames` with
+    dependencies before the blocks that use them.
+    """
+    if included_dependencies is None:
+        included_dependencies = set()
+    if include_filenames is None:
+        include_filenames = []
+    build_graph.resolve(package, (filename,), extraargs,
+                        included_dependencies, include_filenames)
     return included_dependencies, include_filenames
 
 def d2pd(package, dependency):
@@ -60,8 +99,180 @@ def d2pd(package, dependency):
 
 def pd2fn(pck, fn):
     return os.path.join(config.verilogdir, pck, fn)
+
+def extraargs_key(extraargs):
+    return json.dumps(extraargs, sort_keys=True, default=repr)
+
+def file_hash(fn):
+    f = open(fn, 'rb')
+    h = hashlib.sha1(f.read()).hexdigest()
+    f.close()
+    return h
+
+class BuildGraph(object):
+    """
+    The dependency graph of the verilog blocks.
+
+    Nodes are (package, filename) pairs from the blocks tables.  The
+    result of running a node's generating function is memoized for each
+    set of extraargs so that blocks shared between builds are only
+    generated once.
+    """
+
+    def __init__(self, blocks, compatibles, incompatibles):
+        self.blocks = blocks
+        self.compatibles = compatibles
+        self.incompatibles = incompatibles
+        # (package, filename, extraargs_key) -> (source mtime,
+        #                                        generated filename,
+        #                                        hash of generated file,
+        #                                        dependency extraargs)
+        self.generated = {}
+
+    def dependencies(self, package, filename):
+        """
+        The (package, filename) nodes that a block directly depends on.
+        """
+        dependencies = self.blocks[package][filename][0]
+        if dependencies is None:
+            dependencies = []
+        return [d2pd(package, d) for d in dependencies]
+
+    def target_dependencies(self, package, name, wrapper='uhd/dut_qa_wrapper.v'):
+        """
+        The dependencies (as listed in the tables) of an executable.
+
+        Args:
+            wrapper: The top level module used with compatible modules.
+        """
+        if name in self.compatibles[package]:
+            dependencies = list(self.compatibles[package][name])
+            dependencies.append(wrapper)
+        else:
+            dependencies = self.incompatibles[package][name]
+        return dependencies
+
+    def generate(self, package, filename, extraargs):
+        """
+        Run a block's generating function unless the result is memoized.
+
+        The memoized result is only used if the generated file has not
+        changed since (a build with other extraargs may have written to
+        the same filename).
+
+        Returns:
+            (generated filename, extraargs for each dependency)
+        """
+        key = (package, filename, extraargs_key(extraargs))
+        source_fn = pd2fn(package, filename)
+        mtime = os.path.getmtime(source_fn)
+        if key in self.generated:
+            old_mtime, out_fn, out_hash, dep_extraargs = self.generated[key]
+            if (old_mtime == mtime and os.path.exists(out_fn) and
+                file_hash(out_fn) == out_hash):
+                return out_fn, dep_extraargs
+        dependencies, generating_function, args = self.blocks[package][filename]
+        if dependencies is None:
+            dependencies = []
+        if args is None:
+            args = {}
+        out_fn, dep_extraargs = generating_function(
+            package, filename, dependencies, extraargs, **args)
+        self.generated[key] = (mtime, out_fn, file_hash(out_fn), dep_extraargs)
+        return out_fn, dep_extraargs
+
+    def resolve(self, package, dependencies, extraargs={},
+                included_dependencies=None, include_filenames=None):
+        """
+        Generate a list of dependencies and everything they depend on.
+
+        Returns:
+            A list of generated filenames in topological order (a block
+            comes after all the blocks it depends on).
+        """
+        if included_dependencies is None:
+            included_dependencies = set()
+        if include_filenames is None:
+            include_filenames = []
+        for d in dependencies:
+            pck, fn = d2pd(package, d)
+            if (pck, fn) not in included_dependencies:
+                self._resolve_node(pck, fn, extraargs, included_dependencies,
+                                   include_filenames)
+        return include_filenames
+
+    def _resolve_node(self, package, filename, extraargs, included_dependencies,
+                      include_filenames):
+        included_dependencies.add((package, filename))
+        out_fn, dep_extraargs = self.generate(package, filename, extraargs)
+        dependencies = self.blocks[package][filename][0]
+        if dependencies is None:
+            dependencies = []
+        for d in dependencies:
+            pck, fn = d2pd(package, d)
+            if (pck, fn) not in included_dependencies:
+                self._resolve_node(pck, fn, dep_extraargs.get(d, {}),
+                                   included_dependencies, include_filenames)
+        include_filenames.append(out_fn)
+
+    def resolve_target(self, package, name, extraargs={},
+                       wrapper='uhd/dut_qa_wrapper.v'):
+        """
+        Generate all the files for an executable.
+        """
+        return self.resolve(package,
+                            self.target_dependencies(package, name, wrapper),
+                            extraargs)
+
+    def affected_targets(self, source):
+        """
+        Find the executables that depend on a verilog source file.
+
+        Args:
+            source: Either a filename or a 'package/filename' string.
+
+        Returns:
+            A sorted list of (package, name) pairs.
+        """
+        if os.path.isabs(source):
+            source = os.path.relpath(source, config.verilogdir)
+        node = tuple(source.split(os.sep))
+        if len(node) != 2 or node[1] not in self.blocks.get(node[0], {}):
+            raise ValueError("{0} is not a known block.".format(source))
+        # Invert the graph.
+        dependents = {}
+        for pck, fns in self.blocks.items():
+            for fn in fns:
+                for dep in self.dependencies(pck, fn):
+                    dependents.setdefault(dep, set()).add((pck, fn))
+        affected = set([node])
+        to_check = [node]
+        while to_check:
+            for dependent in dependents.get(to_check.pop(), []):
+                if dependent not in affected:
+                    affected.add(dependent)
+                    to_check.append(dependent)
+        targets = []
+        for tables in (self.compatibles, self.incompatibles):
+            for package, names in tables.items():
+                for name in names:
+                    deps = self.target_dependencies(package, name)
+                    if affected.intersection([d2pd(package, d) for d in deps]):
+                        targets.append((package, name))
+        return sorted(targets)
     
-def generate_B100_image(package, name, suffix, defines=config.default_defines, extraargs={}):
+def generate_B100_image(package, name, suffix, defines=config.default_defines, extraargs={},
+                        make_command=None):
+    """
+    Generate an image for the B100.
+
+    Images are only synthesised if the same sources and defines have
+    not been synthesised before.  Previous images are kept in the b100
+    image store.
+
+    Args:
+        make_command: Overrides the command used to run the synthesis.
+    """
     builddir = os.path.join(config.builddir, package)
     outputdir = os.path.join(builddir, 'build-B100_{name}{suffix}'.format(
             name=name, suffix=suffix))
@@ -70,12 +281,9 @@ def generate_B100_image(package, name, suffix, defines=config.default_defines, e
     if not os.path.exists(vdir):
         os.makedirs(vdir)
     dependencies = compatibles[package][name]
-    included_dependencies = set()
     inputfiles = [os.path.join(pd2fn('uhd', 'u1plus_core_QA.v'))]
-    for d in dependencies:
-        pck, fn = d2pd(package, d)
-        if (pck, fn) not in included_dependencies:
-            generate_block(pck, fn, extraargs, included_dependencies, inputfiles)
+    build_graph.resolve(package, dependencies, extraargs,
+                        include_filenames=inputfiles)
     new_inputfiles= []
     changed = False
     for f in inputfiles:
@@ -94,39 +302,225 @@ def generate_B100_image(package, name, suffix, defines=config.default_defines, e
             shutil.copyfile(f2, f3)
         new_inputfiles.append(f3)
     image_fn = os.path.join(outputdir, 'B100.bin')
-    if changed or not os.path.exists(image_fn):
-        b100.make_make(name+suffix, builddir, new_inputfiles, defines)
-        return b100.synthesise(name+suffix, builddir)
-    else:
+    if not changed and os.path.exists(image_fn):
         return image_fn
+    key = b100.image_key(new_inputfiles, defines)
+    stored_fn = b100.stored_image(key)
+    if stored_fn is not None:
+        logger.debug("Using stored image {0}".format(stored_fn))
+        if not os.path.exists(outputdir):
+            os.makedirs(outputdir)
+        shutil.copyfile(stored_fn, image_fn)
+        return image_fn
+    b100.make_make(name+suffix, builddir, new_inputfiles, defines)
+    image_fn = b100.synthesise(name+suffix, builddir, make_command)
+    logfile_fn = os.path.join(builddir, 'Make.B100_{0}.log'.format(name+suffix))
+    b100.store_image(key, image_fn, logfile_fn)
+    return image_fn
+
+def prepare_icarus_executable(package, name, suffix, defines=config.default_defines, extraargs={},
+                              file_driven=False):
+    """
+    Generate the input files for an icarus executable.
 
-def generate_icarus_executable(package, name, suffix, defines=config.default_defines, extraargs={}):
+    Args:
+        file_driven: Use uhd/file_qa_wrapper.v as the top level module so
+            the executable can be run with TestBenchIcarusFile rather than
+            through myhdl.
+
+    Returns:
+        (executable, inputfiles) where executable is the filename the
+        executable should be compiled to.
+    """
     builddir = os.path.join(config.builddir, package)
-    if name in compatibles[package]:
-        dependencies = compatibles[package][name]
-        dependencies = list(dependencies)
-        dependencies.append('uhd/dut_qa_wrapper.v')
+    if file_driven:
+        if name not in compatibles[package]:
+            raise ValueError("{0} does not use qa_wrapper so cannot be file driven.".format(name))
+        wrapper = 'uhd/file_qa_wrapper.v'
+        suffix += '-file'
     else:
-        dependencies = incompatibles[package][name]        
-    included_dependencies = set()
-    inputfiles = []
-    for d in dependencies:
-        pck, fn = d2pd(package, d)
-        if (pck, fn) not in included_dependencies:
-            generate_block(pck, fn, extraargs, included_dependencies, inputfiles)
-    inputfilestr = ' '.join(inputfiles)
-    print(inputfilestr)
+        wrapper = 'uhd/dut_qa_wrapper.v'
+    inputfiles = build_graph.resolve_target(package, name, extraargs, wrapper)
     executable = name + suffix
     executable = os.path.join(builddir, executable)
-    definestr = make_define_string(defines)
-    cmd = ("iverilog -o {executable} {definestr} {inputfiles}"
-           ).format(executable=executable,
-                    definestr=definestr,
-                    inputfiles=inputfilestr)
-    logger.debug(cmd)
-    os.system(cmd)
+    return executable, inputfiles
+
+def compile_icarus_executable(executable, inputfiles, defines):
+    """
+    Run iverilog.  Returns True if the compilation succeeded.
+    """
+    args = (['iverilog', '-o', executable] + make_define_args(defines)
+            + list(inputfiles))
+    logger.debug(' '.join(args))
+    return subprocess.call(args) == 0
+
+def fetch_cached_icarus_executable(executable, cached_fn):
+    """
+    Copy a cached executable into place if there is one.
+    Returns True if the cache was used.
+    """
+    if os.path.exists(cached_fn):
+        icarus_cache_stats['hits'] += 1
+        logger.debug("Using cached executable {0}".format(cached_fn))
+        shutil.copyfile(cached_fn, executable)
+        return True
+    icarus_cache_stats['misses'] += 1
+    return False
+
+def make_cachedir():
+    try:
+        os.makedirs(icarus_cachedir)
+    except OSError, e:
+        # Another process may have just made it.
+        if e.errno != errno.EEXIST:
+            raise
+
+def store_cached_icarus_executable(executable, cached_fn):
+    """
+    Copy an executable into the cache.
+
+    The executable is copied to a temporary file that is then renamed so
+    that nothing ever sees a partly copied executable.
+    """
+    make_cachedir()
+    fd, tmp_fn = tempfile.mkstemp(dir=icarus_cachedir, prefix='.tmp-')
+    os.close(fd)
+    try:
+        shutil.copyfile(executable, tmp_fn)
+        shutil.copymode(executable, tmp_fn)
+        os.rename(tmp_fn, cached_fn)
+    finally:
+        if os.path.exists(tmp_fn):
+            os.remove(tmp_fn)
+
+def generate_icarus_executable(package, name, suffix, defines=config.default_defines, extraargs={},
+                               file_driven=False):
+    executable, inputfiles = prepare_icarus_executable(
+        package, name, suffix, defines, extraargs, file_driven)
+    print(' '.join(inputfiles))
+    cached_fn = os.path.join(icarus_cachedir,
+                             icarus_build_hash(inputfiles, defines))
+    if not fetch_cached_icarus_executable(executable, cached_fn):
+        if compile_icarus_executable(executable, inputfiles, defines):
+            store_cached_icarus_executable(executable, cached_fn)
     return executable
 
+def snapshot_inputfiles(inputfiles, build_hash):
+    """
+    Copy the input files of a build into their own directory so that
+    later builds writing to the same generated filenames cannot change
+    them before they are compiled.
+
+    Returns:
+        (snapdir, filenames) where filenames are the copies (in the same
+        order) and snapdir is the directory to remove once they are
+        compiled.
+    """
+    try:
+        os.makedirs(icarus_inputsdir)
+    except OSError, e:
+        if e.errno != errno.EEXIST:
+            raise
+    # Builds with the same hash each get their own directory so one
+    # can be removed while the other is still compiling.
+    snapdir = tempfile.mkdtemp(dir=icarus_inputsdir, prefix=build_hash+'-')
+    snapshot = []
+    for i, fn in enumerate(inputfiles):
+        # The index keeps files from different packages apart.
+        snap_fn = os.path.join(snapdir, '{0:03d}_{1}'.format(
+                i, os.path.basename(fn)))
+        shutil.copyfile(fn, snap_fn)
+        snapshot.append(snap_fn)
+    return snapdir, snapshot
+
+def _compile_icarus_job(executable, snapdir, inputfiles, defines, cached_fn):
+    """
+    Run by the worker processes of generate_icarus_executables.
+    """
+    try:
+        if not compile_icarus_executable(executable, inputfiles, defines):
+            raise StandardError("Failed to compile {0}".format(executable))
+    finally:
+        shutil.rmtree(snapdir)
+    store_cached_icarus_executable(executable, cached_fn)
+    return executable
+
+class FinishedBuild(object):
+    """
+    Stands in for a multiprocessing AsyncResult when an executable
+    did not need compiling.
+    """
+
+    def __init__(self, executable):
+        self.executable = executable
+
+    def ready(self):
+        return True
+
+    def successful(self):
+        return True
+
+    def wait(self, timeout=None):
+        pass
+
+    def get(self, timeout=None):
+        return self.executable
+
+def generate_icarus_executables(build_requests, processes=None):
+    """
+    Generate a batch of icarus executables, compiling them in parallel.
+
+    The input files for all the requests are generated first (in this
+    process) and then iverilog is run in a pool of processes.  The input
+    files of each request that is not in the cache are hashed and copied
+    into their own directory as soon as they are generated, since a later
+    request may generate different contents under the same filenames.
+    The copies are removed once they are compiled.
+
+    Args:
+        build_requests: A list of (package, name, suffix, defines, extraargs)
+            tuples (the arguments of generate_icarus_executable).
+        processes: The number of compiler processes (defaults to the
+            number of cpus).
+
+    Returns:
+        A list of results in the same order as build_requests.  Calling
+        `get` on a result waits for the compilation to finish and returns
+        the executable filename (as for a multiprocessing AsyncResult).
+    """
+    jobs = []
+    results = {}
+    for package, name, suffix, defines, extraargs in build_requests:
+        executable, inputfiles = prepare_icarus_executable(
+            package, name, suffix, defines, extraargs)
+        build_hash = icarus_build_hash(inputfiles, defines)
+        cached_fn = os.path.join(icarus_cachedir, build_hash)
+        if executable in results:
+            if results[executable][0] != cached_fn:
+                raise ValueError("Two different builds for {0} were requested.".format(executable))
+        elif fetch_cached_icarus_executable(executable, cached_fn):
+            results[executable] = (cached_fn, None, None, defines)
+        else:
+            snapdir, inputfiles = snapshot_inputfiles(inputfiles, build_hash)
+            results[executable] = (cached_fn, snapdir, inputfiles, defines)
+        jobs.append(executable)
+    # Made here rather than by the workers to avoid them racing.
+    make_cachedir()
+    pool = None
+    futures = {}
+    for executable, (cached_fn, snapdir, inputfiles, defines) in results.items():
+        if snapdir is None:
+            futures[executable] = FinishedBuild(executable)
+        else:
+            if pool is None:
+                pool = multiprocessing.Pool(processes)
+            futures[executable] = pool.apply_async(
+                _compile_icarus_job,
+                (executable, snapdir, inputfiles, defines, cached_fn))
+    if pool is not None:
+        pool.close()
+    return [futures[executable] for executable in jobs]
+
 packages = {'message': message,
             'uhd': uhd,
             'flow': flow,
@@ -144,3 +538,4 @@ compatibles = dict([(key, getattr(sp, 'compatibles')) for
 incompatibles = dict([(key, getattr(sp, 'incompatibles')) for
                       key, sp in packages.items()])
 
+build_graph = BuildGraph(blocks, compatibles, incompatibles)
@@ -0,0 +1,93 @@
+"""
+Fast reference model of a polyphase filterbank channelizer.
+
+pfb_channelizer gives the same results as pychannelizer but does the
+convolutions for all the polyphase branches with FFTs and then one FFT
+across the branches for every output sample.
+"""
+
+import numpy
+from numpy import fft
+
+def convolve(X, Y):
+    """
+    Convolves two series.
+    """
+    N = len(X)
+    ss = []
+    for n in range(0, len(Y)):
+        s = 0
+        for l in range(0, len(X)):
+            s += X[l].conjugate()*Y[(n+l)%len(Y)]
+        ss.append(s)
+    return ss
+
+def pychannelizer(flts, data, M):
+    """
+    Implements a pfb channelizer in python.
+    """
+    css = [data[i::M] for i in range(M)]
+    convolved = [convolve(flts[i], css[i]) for i in range(M)]
+    channels = []
+    for k in range(M):
+        filtered = [fft.fft(c)[k] for c in zip(*convolved)]
+        channels.append([x for x in filtered])
+    return convolved, channels
+
+def circular_correlate(X, Y):
+    """
+    Same as convolve.
+
+    ss[n] = sum_l X[l].conjugate() * Y[(n+l)%len(Y)]
+
+    Args:
+        X: The filter taps.  Taps beyond len(Y) wrap around.
+        Y: The data.  The last axis is correlated so a 2D array of
+           branches with equal lengths can be done at once.
+    """
+    Y = numpy.asarray(Y, dtype=complex)
+    X = numpy.asarray(X, dtype=complex)
+    L = Y.shape[-1]
+    if L == 0:
+        # Branches that received no data have no output.
+        return numpy.zeros(Y.shape, dtype=complex)
+    # Fold the taps into a single period of the data.
+    folded = numpy.zeros(X.shape[:-1] + (L,), dtype=complex)
+    for start in range(0, X.shape[-1], L):
+        chunk = X[..., start: start+L]
+        folded[..., :chunk.shape[-1]] += chunk
+    return numpy.fft.ifft(numpy.fft.fft(Y) * numpy.fft.fft(folded).conjugate())
+
+def pfb_channelizer(flts, data, M):
+    """
+    Implements a pfb channelizer.
+
+    Args:
+        flts: The taps for each of the M branches.
+        data: The input samples.
+        M: The number of channels.
+
+    Returns:
+        A tuple (convolved, channels).  convolved is a list of arrays with
+        the filtered data in each branch.  channels is an (M, n) array
+        with the output of each channel.
+    """
+    data = numpy.asarray(data, dtype=complex)
+    css = [data[i::M] for i in range(M)]
+    convolved = [None]*M
+    # Branches with the same length are filtered together.
+    lengths = sorted(set([len(cs) for cs in css]))
+    for length in lengths:
+        indices = [i for i in range(M) if len(css[i]) == length]
+        n_taps = max([len(flts[i]) for i in indices])
+        taps = numpy.zeros((len(indices), n_taps), dtype=complex)
+        for j, i in enumerate(indices):
+            taps[j, :len(flts[i])] = flts[i]
+        branches = numpy.array([css[i] for i in indices])
+        filtered = circular_correlate(taps, branches)
+        for j, i in enumerate(indices):
+            convolved[i] = filtered[j]
+    n = lengths[0]
+    stacked = numpy.array([c[:n] for c in convolved])
+    channels = numpy.fft.fft(stacked, axis=0)
+    return convolved, channels
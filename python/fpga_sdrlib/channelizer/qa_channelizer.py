@@ -10,39 +10,14 @@ import unittest
 import math
 
 from myhdl import always
-from numpy import fft
 from scipy import signal
 
 from fpga_sdrlib import config
 from fpga_sdrlib.channelizer.build import generate_channelizer_executable
+from fpga_sdrlib.channelizer.pfb import pychannelizer
 from fpga_sdrlib.testbench import TestBenchIcarus
 from fpga_sdrlib.filterbank.qa_filterbank import scale_taps, taps_to_start_msgs, FilterbankTestBenchIcarus
 
-def convolve(X, Y):
-    """
-    Convolves two series.
-    """
-    N = len(X)
-    ss = []
-    for n in range(0, len(Y)):
-        s = 0
-        for l in range(0, len(X)):
-            s += X[l].conjugate()*Y[(n+l)%len(Y)]
-        ss.append(s)
-    return ss
-
-def pychannelizer(flts, data, M):
-    """
-    Implements a pfb channelizer in python.
-    """
-    css = [data[i::M] for i in range(M)]
-    convolved = [convolve(flts[i], css[i]) for i in range(M)]
-    channels = []
-    for k in range(M):
-        filtered = [fft.fft(c)[k] for c in zip(*convolved)]
-        channels.append([x for x in filtered])
-    return convolved, channels
-
 class ChannelizerTestBenchIcarus(TestBenchIcarus):
     """
     Helper class for doing testing.
@@ -0,0 +1,55 @@
+# Copyright (c) 2012 Ben Reynwar
+# Released under MIT License (see LICENSE.txt)
+
+"""
+Check the FFT based channelizer model against the direct one.
+"""
+
+import random
+import unittest
+
+import numpy
+
+from fpga_sdrlib.channelizer.pfb import pfb_channelizer, pychannelizer
+
+class TestPFBChannelizer(unittest.TestCase):
+    """
+    Test the FFT based channelizer model against pychannelizer.
+    """
+
+    def test_pfb_channelizer(self):
+        rg = random.Random(0)
+        M = 4
+        # Includes a length that does not divide into the channels and
+        # branches shorter than the filters.
+        for n_data, n_taps in ((123, 25), (40, 25)):
+            data = [rg.random()*2-1 + rg.random()*2j-1j for i in range(n_data)]
+            flts = [[rg.random()*2-1 + rg.random()*2j-1j for i in range(n_taps)]
+                    for m in range(M)]
+            p_convolved, p_final = pychannelizer(flts, data, M)
+            f_convolved, f_final = pfb_channelizer(flts, data, M)
+            for p, f in zip(p_convolved, f_convolved):
+                self.assertTrue(numpy.max(numpy.abs(numpy.array(p) - f)) < 1e-9)
+            self.assertTrue(numpy.max(numpy.abs(numpy.array(p_final) - f_final)) < 1e-9)
+
+    def test_short_data(self):
+        """
+        Fewer samples than channels leaves some branches empty.
+        """
+        rg = random.Random(0)
+        M = 4
+        data = [rg.random()*2-1 + rg.random()*2j-1j for i in range(M-1)]
+        flts = [[rg.random()*2-1 + rg.random()*2j-1j for i in range(5)]
+                for m in range(M)]
+        p_convolved, p_final = pychannelizer(flts, data, M)
+        f_convolved, f_final = pfb_channelizer(flts, data, M)
+        for p, f in zip(p_convolved, f_convolved):
+            self.assertEqual(len(p), len(f))
+            if len(p):
+                self.assertTrue(numpy.max(numpy.abs(numpy.array(p) - f)) < 1e-9)
+        self.assertEqual(f_final.shape, (M, 0))
+        for p in p_final:
+            self.assertEqual(len(p), 0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -9,8 +9,12 @@ All complex numbers components must be between -1 and 1.
 The real component goes to the high bits of the integer and the imaginary
 component to the low bits.
 
+The *_array functions operate on whole numpy arrays and give results that
+are identical to applying the scalar functions element by element.
 """
 
+import numpy
+
 def c_to_int(c, x_width):
     """
     Takes a complex number and a width.
@@ -58,6 +62,32 @@ def int_to_c(k, x_width):
     q = int_to_f(qk, x_width)
     return i + (0+1j)*q
 
+def c_to_int_array(cs, x_width):
+    """
+    Takes a sequence of complex numbers and a width.
+    Returns a uint64 array where each element is what c_to_int would
+    give for the corresponding complex number.
+    """
+    cs = numpy.asarray(cs, dtype=complex)
+    mask = numpy.uint64(pow(2, x_width)-1)
+    i = f_to_sint_array(cs.real, x_width).astype(numpy.uint64) & mask
+    q = f_to_sint_array(cs.imag, x_width).astype(numpy.uint64) & mask
+    return (i << numpy.uint64(x_width)) | q
+
+def int_to_c_array(ks, x_width):
+    """
+    Takes a sequence of integers and a width.
+    Returns a complex array where each element is what int_to_c would
+    give for the corresponding integer.
+    """
+    ks = numpy.asarray(ks, dtype=numpy.uint64)
+    ik = ks >> numpy.uint64(x_width)
+    qk = ks & numpy.uint64(pow(2, x_width)-1)
+    cs = numpy.empty(ks.shape, dtype=complex)
+    cs.real = int_to_f_array(ik, x_width)
+    cs.imag = int_to_f_array(qk, x_width)
+    return cs
+
 def f_to_sint(f, x_width, clean1=False):
     """
     Takes a float and returns a signed integer.
@@ -76,6 +106,25 @@ def f_to_sint(f, x_width, clean1=False):
     i = int(round(f*maxint))
     return i
 
+def f_to_sint_array(fs, x_width, clean1=False):
+    """
+    Takes an array of floats and returns an int64 array of signed integers.
+
+    Rounds half away from zero so that the results match f_to_sint.
+    """
+    fs = numpy.asarray(fs, dtype=float)
+    if numpy.any((fs < -1) | (fs > 1)):
+        raise ValueError("The tap must be between -1 and 1.")
+    if clean1 is False:
+        maxint = pow(2, x_width-1)-1
+    else:
+        maxint = pow(2, x_width-2)
+    scaled = fs*maxint
+    magnitude = numpy.abs(scaled)
+    rounded = numpy.floor(magnitude)
+    rounded += (magnitude - rounded) >= 0.5
+    return (numpy.sign(scaled)*rounded).astype(numpy.int64)
+
 def sint_to_int(si, width):
     """
     Converts a signed integer to a two complement integer.
@@ -101,6 +150,18 @@ def int_to_sint(i, width):
 def int_to_f(i, width):
     return sint_to_f(int_to_sint(i, width), width)
 
+def int_to_f_array(iis, width):
+    """
+    Takes an array of unsigned integers and returns a float array
+    where each element is what int_to_f would give.
+    """
+    iis = numpy.asarray(iis, dtype=numpy.uint64)
+    middleint = numpy.uint64(pow(2, width)//2)
+    sis = iis.astype(numpy.int64)
+    sis[iis >= middleint] -= pow(2, width)
+    maxint = pow(2, width-1)-1
+    return sis/float(maxint)
+
 def f_to_istr(width, f):
     """
     f is between 0 and 1.
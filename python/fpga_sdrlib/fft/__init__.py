@@ -3,12 +3,14 @@ Utility functions to help with generation and verification of
 verilog fft code.
 """
 
-import cmath
 import os
+import logging
 
 from fpga_sdrlib import config
-from fpga_sdrlib.conversions import cs_to_dicts
 from fpga_sdrlib.generate import copyfile, logceil, format_template
+from fpga_sdrlib.fft import twiddle
+
+logger = logging.getLogger(__name__)
 
 def fft_length_template(pck, fn, dependencies, extraargs={}):
     fft_length = extraargs.get('N', None)
@@ -30,6 +32,12 @@ def fft_length_template(pck, fn, dependencies, extraargs={}):
     return out_fn, out_extraargs
 
 def make_twiddlefactors(pck, fn, dependencies, extraargs={}):
+    """
+    Generate twiddlefactors_N_width.v (or twiddlefactors_folded_N_width.v)
+
+    If extraargs contains fold_twiddles=True then only an eighth of a turn
+    is stored in the ROM (when that gives exactly the same values).
+    """
     # dependencies is not used
     fft_length = extraargs.get('N', None)
     width = extraargs.get('width', None)
@@ -37,17 +45,43 @@ def make_twiddlefactors(pck, fn, dependencies, extraargs={}):
         raise ValueError("N for twiddlefactors.v is not known.")
     if width is None:
         raise ValueError("width for twidlefactors.v is not known.")
-    vs = [cmath.exp(-i*2j*cmath.pi/fft_length) for i in range(0, fft_length/2)]
-    tfs = cs_to_dicts(vs, width, clean1=False)
+    assert(fn == 'twiddlefactors.v.t')
+    folded = extraargs.get('fold_twiddles', False)
+    if folded and not twiddle.folds_exactly(fft_length, width):
+        logger.warning("Cannot fold twiddle factors for N={0}.  Using the full table.".format(fft_length))
+        folded = False
+    if folded:
+        cos, sin = twiddle.folded_table(fft_length, width)
+        tfs = [{'i': i, 'c': c, 's': s}
+               for i, (c, s) in enumerate(zip(cos.tolist(), sin.tolist()))]
+        template_fn = 'twiddlefactors_folded.v.t'
+    else:
+        re, im = twiddle.twiddle_table(fft_length, width)
+        tfs = []
+        for i, (r, m) in enumerate(zip(re.tolist(), im.tolist())):
+            tfs.append({'i': i,
+                        're_sign': '' if r >= 0 else '-', 're': str(abs(r)),
+                        'im_sign': '' if m >= 0 else '-', 'im': str(abs(m))})
+        template_fn = fn
+    entries, bits = twiddle.rom_size(fft_length, width, folded)
+    logger.info("Twiddle factor ROM for N={0}: {1} entries, {2} bits ({3:.1%} of B100 block RAM)".format(
+            fft_length, entries, bits, float(bits)/twiddle.b100_block_ram_bits))
     tf_dict = {
         'N': fft_length,
         'log_N': logceil(fft_length),
         'width': width,
         'tfs': tfs,
         }
-    assert(fn == 'twiddlefactors.v.t')
-    twiddlefactors_fn = 'twiddlefactors_{0}.v'.format(fft_length)
-    in_fn = os.path.join(config.verilogdir, pck, fn)
+    if folded:
+        tf_dict['Q'] = fft_length//8
+        tf_dict['log_Q'] = logceil(fft_length//8)
+    # The folded and full tables give modules with the same name so they
+    # need different files.
+    if folded:
+        twiddlefactors_fn = 'twiddlefactors_folded_{0}_{1}.v'.format(fft_length, width)
+    else:
+        twiddlefactors_fn = 'twiddlefactors_{0}_{1}.v'.format(fft_length, width)
+    in_fn = os.path.join(config.verilogdir, pck, template_fn)
     out_fn = os.path.join(config.builddir, pck, twiddlefactors_fn)
     out_dir = os.path.join(config.builddir, pck)
     if not os.path.exists(out_dir):
@@ -1,8 +1,20 @@
 """
 Python implementation of FFT to test verilog against.
+
+pystage and pyditfft use floating point.  The fixed_* functions model
+the integer arithmetic of the verilog (butterfly.v, multiply_complex.v
+and multiply.v) exactly and operate on whole numpy arrays.  Complex
+fixed point values are passed around as a pair (re, im) of int64 arrays
+holding the signed components.
 """
 import math
 import cmath
+import multiprocessing
+
+import numpy
+
+from fpga_sdrlib.conversions import f_to_sint_array
+from fpga_sdrlib.fft import twiddle
 
 def pystage(N, start_index, in_data):
     assert(len(in_data) == N)
@@ -38,6 +50,210 @@ def pyditfft(data):
         data = pystage(N, i, data)
     return data
 
+def wrap(xs, width):
+    """
+    Keep the lowest `width` bits of signed integers (as a verilog
+    assignment to a narrower signed wire does).
+    """
+    offset = pow(2, width-1)
+    return ((xs + offset) & (pow(2, width)-1)) - offset
+
+def trunc_div2(xs):
+    """
+    Signed division by 2 rounding towards zero (as in verilog).
+    """
+    return numpy.where(xs < 0, -((-xs) >> 1), xs >> 1)
+
+def fixed_multiply(xs, ys, width):
+    """
+    Model of multiply.v.
+    """
+    return wrap((xs * ys) >> (width-1), width)
+
+def fixed_multiply_complex(x, y, width):
+    """
+    Model of multiply_complex.v.
+    The result is x*y/2.
+
+    Args:
+        x, y: (re, im) pairs.
+        width: The width of a complex number.
+    """
+    cw = width//2
+    x_re, x_im = x
+    y_re, y_im = y
+    xreyre = fixed_multiply(x_re, y_re, cw)
+    xreyim = fixed_multiply(x_re, y_im, cw)
+    ximyre = fixed_multiply(x_im, y_re, cw)
+    ximyim = fixed_multiply(x_im, y_im, cw)
+    z_re = wrap((xreyre - ximyim) >> 1, cw)
+    z_im = wrap((xreyim + ximyre) >> 1, cw)
+    return z_re, z_im
+
+def fixed_butterfly(xa, xb, w, width):
+    """
+    Model of butterfly.v.
+    Returns ya = (xa + xb*w)/2 and yb = (xa - xb*w)/2.
+    """
+    cw = width//2
+    xbw_re, xbw_im = fixed_multiply_complex(xb, w, width)
+    xa_re_z = trunc_div2(xa[0])
+    xa_im_z = trunc_div2(xa[1])
+    ya = (wrap(xa_re_z + xbw_re, cw), wrap(xa_im_z + xbw_im, cw))
+    yb = (wrap(xa_re_z - xbw_re, cw), wrap(xa_im_z - xbw_im, cw))
+    return ya, yb
+
+def fixed_twiddlefactors(N, width, clean1=False):
+    """
+    The twiddle factors as quantized in twiddlefactors.v.t.
+
+    The default of clean1=False matches fft.make_twiddlefactors.
+
+    Returns:
+        A (re, im) pair of arrays of length N/2.
+    """
+    return twiddle.twiddle_table(N, width, clean1)
+
+def fixed_stage(N, stage_index, data, tfs, width):
+    """
+    Fixed point version of pystage.
+
+    Args:
+        N: FFT length.
+        stage_index: The stage (0 to log2(N)-1).
+        data: A (re, im) pair of arrays.  The last axis has length N so
+            that a batch of frames can be processed at once.
+        tfs: The twiddle factors from fixed_twiddlefactors.
+        width: The width of a complex number.
+    """
+    re, im = data
+    assert(re.shape[-1] == N)
+    # S is number of interleaved transforms.
+    S = N//2//pow(2, stage_index)
+    out_addr0 = numpy.arange(N//2)
+    k = out_addr0 // S
+    j = out_addr0 % S
+    in_addr0 = 2*k*S + j
+    in_addr1 = in_addr0 + S
+    tf_addr = k*S
+    A = (re[..., in_addr0], im[..., in_addr0])
+    B = (re[..., in_addr1], im[..., in_addr1])
+    W = (tfs[0][tf_addr], tfs[1][tf_addr])
+    C, D = fixed_butterfly(A, B, W, width)
+    return (numpy.concatenate((C[0], D[0]), axis=-1),
+            numpy.concatenate((C[1], D[1]), axis=-1))
+
+def fixed_ditfft_stages(data, width, clean1=False):
+    """
+    Fixed point version of pyditfft that returns the output of every stage.
+
+    Each stage divides by 2 so the final output is the FFT divided by N.
+
+    Args:
+        data: A (re, im) pair of integer arrays with the frames along the
+            last axis.
+        width: The width of a complex number.
+        clean1: How the twiddle factors are quantized.
+
+    Returns:
+        A list of (re, im) pairs, one for each stage.
+    """
+    re = numpy.asarray(data[0], dtype=numpy.int64)
+    im = numpy.asarray(data[1], dtype=numpy.int64)
+    N = re.shape[-1]
+    log_N = math.log(N)/math.log(2)
+    if log_N != int(log_N):
+        raise ValueError("len(data) must be a power of 2")
+    log_N = int(log_N)
+    tfs = fixed_twiddlefactors(N, width, clean1)
+    data = (re, im)
+    stages = []
+    for i in range(log_N):
+        data = fixed_stage(N, i, data, tfs, width)
+        stages.append(data)
+    return stages
+
+def fixed_ditfft(data, width, clean1=False):
+    """
+    Fixed point version of pyditfft.
+
+    Each stage divides by 2 so the output is the FFT divided by N.
+    See fixed_ditfft_stages for the arguments.
+    """
+    return fixed_ditfft_stages(data, width, clean1)[-1]
+
+def _fixed_ditfft_frames(args):
+    """
+    Run by the worker processes of fixed_ditfft_frames.
+    """
+    re, im, width, clean1 = args
+    stages = fixed_ditfft_stages((re, im), width, clean1)
+    return (numpy.array([stage[0] for stage in stages]),
+            numpy.array([stage[1] for stage in stages]))
+
+def fixed_ditfft_frames(frames, width, clean1=False, processes=None):
+    """
+    Expected output of the verilog FFT for a batch of frames.
+
+    Args:
+        frames: An (n_frames, N) array of complex numbers.
+        width: The width of a complex number.
+        clean1: How the twiddle factors are quantized.
+        processes: If not None the frames are split between this many
+            worker processes.
+
+    Returns:
+        A tuple (outputs, stage_outputs).  outputs is an (n_frames, N)
+        complex array of the transforms.  stage_outputs is a (re, im) pair
+        of integer arrays of shape (log2(N), n_frames, N) with the output
+        of each stage (useful for checking stage_to_stage).
+    """
+    re, im = to_fixed(frames, width)
+    if re.ndim != 2:
+        raise ValueError("frames must have shape (n_frames, N)")
+    if processes is None or processes < 2 or len(re) < 2:
+        stages_re, stages_im = _fixed_ditfft_frames((re, im, width, clean1))
+    else:
+        n_chunks = min(processes, len(re))
+        chunks = [(r, i, width, clean1) for r, i in
+                  zip(numpy.array_split(re, n_chunks),
+                      numpy.array_split(im, n_chunks))]
+        pool = multiprocessing.Pool(processes)
+        try:
+            results = pool.map(_fixed_ditfft_frames, chunks)
+        finally:
+            pool.close()
+            pool.join()
+        stages_re = numpy.concatenate([r[0] for r in results], axis=1)
+        stages_im = numpy.concatenate([r[1] for r in results], axis=1)
+    outputs = from_fixed((stages_re[-1], stages_im[-1]), width)
+    return outputs, (stages_re, stages_im)
+
+def to_fixed(cs, width):
+    """
+    Convert complex numbers to a (re, im) pair of signed integer arrays.
+    """
+    cs = numpy.asarray(cs, dtype=complex)
+    return (f_to_sint_array(cs.real, width//2),
+            f_to_sint_array(cs.imag, width//2))
+
+def from_fixed(data, width):
+    """
+    Convert a (re, im) pair of signed integer arrays to complex numbers.
+    """
+    maxint = float(pow(2, width//2-1)-1)
+    return (numpy.asarray(data[0])/maxint +
+            1j*(numpy.asarray(data[1])/maxint))
+
+def raw_to_fixed(raw, width):
+    """
+    Split raw words (as in TestBenchIcarusInner.out_raw) into a (re, im)
+    pair of signed integer arrays.
+    """
+    cw = width//2
+    raw = numpy.asarray(raw, dtype=numpy.int64)
+    return (wrap(raw >> cw, cw), wrap(raw & (pow(2, cw)-1), cw))
+
 if __name__ == '__main__':
     import random
     n_data = 16
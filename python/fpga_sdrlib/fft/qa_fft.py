@@ -6,13 +6,16 @@ import random
 import unittest
 import logging
 import shutil
+import tempfile
+import numpy
 from numpy import fft
 
 from fpga_sdrlib.message import msg_utils
-from fpga_sdrlib.conversions import int_to_c
+from fpga_sdrlib.conversions import int_to_c, c_to_int_array
 from fpga_sdrlib.generate import logceil
-from fpga_sdrlib import config, b100, buildutils
+from fpga_sdrlib import config, b100, buildutils, generate
 from fpga_sdrlib.testbench import TestBenchB100, TestBenchIcarusInner, TestBenchIcarusOuter
+from fpga_sdrlib.fft import dit, twiddle
 from fpga_sdrlib.fft.dit import pystage
 
 logger = logging.getLogger(__name__)
@@ -223,6 +226,13 @@ class TestStageToStage(unittest.TestCase):
                 self.assertEqual(len(tb.out_ms), len(in_ms))
                 for r, e in zip(tb.out_ms, in_ms):
                     self.assertEqual(e, r)
+        # The fixed point model must match the verilog exactly.
+        frames = dit.to_fixed(numpy.reshape(in_samples, (n_data/N, N)), width)
+        tfs = dit.fixed_twiddlefactors(N, width)
+        e_re, e_im = dit.fixed_stage(N, stage_index, frames, tfs, width)
+        r_re, r_im = dit.raw_to_fixed(tb_icarus_inner.out_raw, width)
+        self.assertEqual(r_re.tolist(), e_re.flatten().tolist())
+        self.assertEqual(r_im.tolist(), e_im.flatten().tolist())
 
 class TestDITSeries(unittest.TestCase):
 
@@ -286,6 +296,352 @@ class TestDITSeries(unittest.TestCase):
                 self.assertEqual(len(tb.out_ms), len(in_ms))
                 for r, e in zip(tb.out_ms, in_ms):
                     self.assertEqual(e, r)
+        # The fixed point model must match the verilog exactly.
+        frames = dit.to_fixed(numpy.reshape(in_samples, (n_data/N, N)), width)
+        e_re, e_im = dit.fixed_ditfft(frames, width)
+        r_re, r_im = dit.raw_to_fixed(tb_icarus_inner.out_raw, width)
+        self.assertEqual(r_re.tolist(), e_re.flatten().tolist())
+        self.assertEqual(r_im.tolist(), e_im.flatten().tolist())
+
+class TestFoldedTwiddles(unittest.TestCase):
+
+    def test_one(self):
+        """
+        The dit_series module gives the same output with a folded twiddle
+        factor ROM.
+        """
+        width = config.default_width
+        sendnth = config.default_sendnth
+        # The smallest N that can be folded.
+        N = 16
+        n_data = 2*N
+        factor = pow(2, -0.5)
+        in_samples = [(random.random()*2-1 + random.random()*2j-1j)*factor
+                      for i in range(n_data)]
+        mwidth = 3
+        in_ms = [random.randint(0, pow(2,mwidth)-1) for d in in_samples]
+        steps_rqd = n_data * sendnth * 2 + 1000
+        defines = config.updated_defines(
+            {'WIDTH': width,
+             'MWIDTH': mwidth,
+             'N': N,
+             })
+        executable_full = buildutils.generate_icarus_executable(
+            'fft', 'dit_series_inner', '-{0}'.format(N), defines=defines,
+            extraargs={'N': N, 'width': width})
+        executable_folded = buildutils.generate_icarus_executable(
+            'fft', 'dit_series_inner', '-{0}-folded'.format(N), defines=defines,
+            extraargs={'N': N, 'width': width, 'fold_twiddles': True})
+        tb_full = TestBenchIcarusInner(executable_full, in_samples, in_ms)
+        tb_folded = TestBenchIcarusInner(executable_folded, in_samples, in_ms)
+        tb_full.run(steps_rqd)
+        tb_folded.run(steps_rqd)
+        self.assertEqual(len(tb_full.out_raw), n_data)
+        self.assertEqual(tb_folded.out_raw, tb_full.out_raw)
+        self.assertEqual(tb_folded.out_ms, tb_full.out_ms)
+
+class TestGeneratedFiles(unittest.TestCase):
+
+    def test_folded_filename(self):
+        """
+        The folded and full twiddle factor tables go in different files.
+        """
+        full_fn, dep_extraargs = buildutils.build_graph.generate(
+            'fft', 'twiddlefactors.v.t', {'N': 16, 'width': 32})
+        folded_fn, dep_extraargs = buildutils.build_graph.generate(
+            'fft', 'twiddlefactors.v.t',
+            {'N': 16, 'width': 32, 'fold_twiddles': True})
+        self.assertEqual(os.path.basename(full_fn), 'twiddlefactors_16_32.v')
+        self.assertEqual(os.path.basename(folded_fn),
+                         'twiddlefactors_folded_16_32.v')
+        self.assertTrue(os.path.exists(full_fn))
+        self.assertTrue(os.path.exists(folded_fn))
+
+    def test_overwritten(self):
+        """
+        A memoized block is generated again if its output was changed.
+        """
+        extraargs = {'N': 16, 'width': 32}
+        out_fn, dep_extraargs = buildutils.build_graph.generate(
+            'fft', 'twiddlefactors.v.t', extraargs)
+        f = open(out_fn, 'r')
+        contents = f.read()
+        f.close()
+        f = open(out_fn, 'w')
+        f.write('// Written by another build.\n')
+        f.close()
+        again_fn, dep_extraargs = buildutils.build_graph.generate(
+            'fft', 'twiddlefactors.v.t', extraargs)
+        self.assertEqual(again_fn, out_fn)
+        f = open(out_fn, 'r')
+        self.assertEqual(f.read(), contents)
+        f.close()
+
+class TestBuildGraph(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix='build_graph_')
+        self.old_verilogdir = config.verilogdir
+        self.old_builddir = config.builddir
+        config.verilogdir = os.path.join(self.tmpdir, 'verilog')
+        config.builddir = os.path.join(self.tmpdir, 'build')
+        self.sources = {'a': ['top.v', 'mid.v', 'other.v'],
+                        'b': ['leaf.v', 'unused.v']}
+        for pck, fns in self.sources.items():
+            os.makedirs(os.path.join(config.verilogdir, pck))
+            for fn in fns:
+                f = open(os.path.join(config.verilogdir, pck, fn), 'w')
+                f.write('// {0}/{1}\n'.format(pck, fn))
+                f.close()
+        self.generated = []
+        def copy(pck, fn, dependencies, extraargs={}):
+            self.generated.append((pck, fn))
+            return generate.copyfile(pck, fn, dependencies, extraargs)
+        blocks = {
+            'a': {'top.v': (('mid.v', 'b/leaf.v'), copy, {}),
+                  'mid.v': (('b/leaf.v',), copy, {}),
+                  'other.v': (None, copy, {})},
+            'b': {'leaf.v': (None, copy, {}),
+                  'unused.v': (None, copy, {})},
+            }
+        incompatibles = {
+            'a': {'top_inner': ('top.v',),
+                  'other_inner': ('other.v',)},
+            'b': {'leaf_inner': ('leaf.v',)},
+            }
+        self.graph = buildutils.BuildGraph(blocks, {'a': {}, 'b': {}},
+                                           incompatibles)
+
+    def tearDown(self):
+        config.verilogdir = self.old_verilogdir
+        config.builddir = self.old_builddir
+        shutil.rmtree(self.tmpdir)
+
+    def test_order(self):
+        """
+        A block comes after the blocks it depends on and only once.
+        """
+        fns = self.graph.resolve_target('a', 'top_inner')
+        self.assertEqual(fns, [os.path.join(config.builddir, 'b', 'leaf.v'),
+                               os.path.join(config.builddir, 'a', 'mid.v'),
+                               os.path.join(config.builddir, 'a', 'top.v')])
+        self.assertEqual(sorted(self.generated),
+                         [('a', 'mid.v'), ('a', 'top.v'), ('b', 'leaf.v')])
+
+    def test_changed_source(self):
+        """
+        Only a changed source is generated again.
+        """
+        self.graph.resolve_target('a', 'top_inner')
+        self.generated = []
+        self.graph.resolve_target('a', 'top_inner')
+        self.assertEqual(self.generated, [])
+        leaf_fn = os.path.join(config.verilogdir, 'b', 'leaf.v')
+        mtime = os.path.getmtime(leaf_fn) + 10
+        os.utime(leaf_fn, (mtime, mtime))
+        self.graph.resolve_target('a', 'top_inner')
+        self.assertEqual(self.generated, [('b', 'leaf.v')])
+
+    def test_affected_targets(self):
+        """
+        Find the executables that use a source file.
+        """
+        self.assertEqual(self.graph.affected_targets('b/leaf.v'),
+                         [('a', 'top_inner'), ('b', 'leaf_inner')])
+        self.assertEqual(self.graph.affected_targets('a/mid.v'),
+                         [('a', 'top_inner')])
+        self.assertEqual(self.graph.affected_targets(
+                os.path.join(config.verilogdir, 'a', 'other.v')),
+                         [('a', 'other_inner')])
+        self.assertEqual(self.graph.affected_targets('b/unused.v'), [])
+        self.assertRaises(ValueError, self.graph.affected_targets, 'a/missing.v')
+
+class TestFormatTemplate(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix='format_template_')
+        self.old_verilogdir = config.verilogdir
+        self.old_environment = generate._environment
+        self.old_get_environment = generate.get_environment
+        config.verilogdir = self.tmpdir
+        # The environment loads templates from config.verilogdir.
+        generate._environment = None
+        self.renders = 0
+        def get_environment():
+            self.renders += 1
+            return self.old_get_environment()
+        generate.get_environment = get_environment
+        self.template_fn = os.path.join(self.tmpdir, 'block.v.t')
+        self.output_fn = os.path.join(self.tmpdir, 'block.v')
+        self.write_template('// N is {{N}}')
+
+    def tearDown(self):
+        config.verilogdir = self.old_verilogdir
+        generate._environment = self.old_environment
+        generate.get_environment = self.old_get_environment
+        shutil.rmtree(self.tmpdir)
+
+    def write_template(self, contents):
+        f = open(self.template_fn, 'w')
+        f.write(contents)
+        f.close()
+        # Make sure jinja sees a new modification time.
+        mtime = os.path.getmtime(self.template_fn) + self.renders + 10
+        os.utime(self.template_fn, (mtime, mtime))
+
+    def output(self):
+        f = open(self.output_fn)
+        contents = f.read()
+        f.close()
+        return contents
+
+    def test_skip(self):
+        """
+        A template is only rendered again if something changed.
+        """
+        generate.format_template(self.template_fn, self.output_fn, {'N': 4})
+        self.assertEqual(self.renders, 1)
+        self.assertEqual(self.output(), '// N is 4')
+        # Nothing changed.
+        generate.format_template(self.template_fn, self.output_fn, {'N': 4})
+        self.assertEqual(self.renders, 1)
+        # Changed arguments.
+        generate.format_template(self.template_fn, self.output_fn, {'N': 8})
+        self.assertEqual(self.renders, 2)
+        self.assertEqual(self.output(), '// N is 8')
+        # Changed template.
+        self.write_template('// N = {{N}}')
+        generate.format_template(self.template_fn, self.output_fn, {'N': 8})
+        self.assertEqual(self.renders, 3)
+        self.assertEqual(self.output(), '// N = 8')
+        # Edited output.
+        f = open(self.output_fn, 'w')
+        f.write('// Edited.')
+        f.close()
+        generate.format_template(self.template_fn, self.output_fn, {'N': 8})
+        self.assertEqual(self.renders, 4)
+        self.assertEqual(self.output(), '// N = 8')
+        # Deleted output.
+        os.remove(self.output_fn)
+        generate.format_template(self.template_fn, self.output_fn, {'N': 8})
+        self.assertEqual(self.renders, 5)
+        self.assertEqual(self.output(), '// N = 8')
+
+class TestFixedDIT(unittest.TestCase):
+
+    def setUp(self):
+        self.rg = random.Random(0)
+
+    def test_butterfly(self):
+        """
+        Compare the fixed point butterfly with a scalar calculation.
+        """
+        width = 32
+        cw = width/2
+        def wrap(x):
+            return (x + pow(2, cw-1)) % pow(2, cw) - pow(2, cw-1)
+        def mult(x, y):
+            return wrap((x*y) >> (cw-1))
+        def div2(x):
+            if x < 0:
+                return -((-x)/2)
+            return x/2
+        extremes = [-pow(2, cw-1), pow(2, cw-1)-1, 0, -1]
+        def rand_int():
+            if self.rg.random() < 0.2:
+                return self.rg.choice(extremes)
+            return self.rg.randint(-pow(2, cw-1), pow(2, cw-1)-1)
+        n_data = 1000
+        xa = [[rand_int() for i in range(n_data)] for c in range(2)]
+        xb = [[rand_int() for i in range(n_data)] for c in range(2)]
+        w = [[rand_int() for i in range(n_data)] for c in range(2)]
+        ya, yb = dit.fixed_butterfly(
+            [numpy.array(x) for x in xa], [numpy.array(x) for x in xb],
+            [numpy.array(x) for x in w], width)
+        for i in range(n_data):
+            xbw_re = wrap((mult(xb[0][i], w[0][i]) - mult(xb[1][i], w[1][i])) >> 1)
+            xbw_im = wrap((mult(xb[0][i], w[1][i]) + mult(xb[1][i], w[0][i])) >> 1)
+            self.assertEqual(ya[0][i], wrap(div2(xa[0][i]) + xbw_re))
+            self.assertEqual(ya[1][i], wrap(div2(xa[1][i]) + xbw_im))
+            self.assertEqual(yb[0][i], wrap(div2(xa[0][i]) - xbw_re))
+            self.assertEqual(yb[1][i], wrap(div2(xa[1][i]) - xbw_im))
+
+    def test_fft(self):
+        """
+        Compare the fixed point FFT with numpy's FFT.
+        """
+        width = 32
+        n_frames = 3
+        for N in (4, 16, 256):
+            frames = numpy.array(
+                [[self.rg.random()*1.4-0.7 + self.rg.random()*1.4j-0.7j
+                  for i in range(N)] for f in range(n_frames)])
+            out = dit.fixed_ditfft(dit.to_fixed(frames, width), width)
+            received = dit.from_fixed(out, width)
+            # The FFT is divided by N to prevent overflow.
+            expected = fft.fft(frames, axis=-1)/N
+            self.assertTrue(numpy.max(numpy.abs(received-expected)) < 0.002)
+            # Processing the frames one at a time gives the same result.
+            for f in range(n_frames):
+                single = dit.fixed_ditfft(dit.to_fixed(frames[f], width), width)
+                self.assertTrue(numpy.all(single[0] == out[0][f]))
+                self.assertTrue(numpy.all(single[1] == out[1][f]))
+
+    def test_frames(self):
+        """
+        Test the batched FFT with and without a pool of processes.
+        """
+        width = 32
+        N = 64
+        n_frames = 10
+        frames = numpy.array(
+            [[self.rg.random()*1.4-0.7 + self.rg.random()*1.4j-0.7j
+              for i in range(N)] for f in range(n_frames)])
+        outputs, stages = dit.fixed_ditfft_frames(frames, width)
+        self.assertEqual(stages[0].shape, (logceil(N), n_frames, N))
+        expected = fft.fft(frames, axis=-1)/N
+        self.assertTrue(numpy.max(numpy.abs(outputs-expected)) < 0.002)
+        # Each stage output is the previous one passed through fixed_stage.
+        tfs = dit.fixed_twiddlefactors(N, width)
+        data = dit.to_fixed(frames, width)
+        for stage_index in range(logceil(N)):
+            data = dit.fixed_stage(N, stage_index, data, tfs, width)
+            self.assertTrue(numpy.all(data[0] == stages[0][stage_index]))
+            self.assertTrue(numpy.all(data[1] == stages[1][stage_index]))
+        pooled_outputs, pooled_stages = dit.fixed_ditfft_frames(
+            frames, width, processes=3)
+        self.assertTrue(numpy.all(pooled_outputs == outputs))
+        self.assertTrue(numpy.all(pooled_stages[0] == stages[0]))
+        self.assertTrue(numpy.all(pooled_stages[1] == stages[1]))
+
+    def test_raw_to_fixed(self):
+        """
+        raw_to_fixed undoes the packing done by the test benches.
+        """
+        width = 32
+        cs = [self.rg.random()*2-1 + self.rg.random()*2j-1j for i in range(100)]
+        cs += [1, -1, 1j, -1j, 0]
+        raw = c_to_int_array(cs, width/2).tolist()
+        re, im = dit.raw_to_fixed(raw, width)
+        e_re, e_im = dit.to_fixed(cs, width)
+        self.assertEqual(re.tolist(), e_re.tolist())
+        self.assertEqual(im.tolist(), e_im.tolist())
+
+    def test_twiddle_fold(self):
+        """
+        The folded twiddle factor ROM reproduces the full table.
+        """
+        width = 32
+        for N in (16, 64, 1024):
+            re, im = twiddle.twiddle_table(N, width)
+            cos, sin = twiddle.folded_table(N, width)
+            self.assertEqual(len(cos), N/8+1)
+            f_re, f_im = twiddle.unfold(N, cos, sin)
+            self.assertTrue(numpy.all(re == f_re))
+            self.assertTrue(numpy.all(im == f_im))
+            self.assertTrue(twiddle.folds_exactly(N, width))
+            self.assertEqual(twiddle.rom_size(N, width, True), (N/8+1, (N/8+1)*width))
+        self.assertFalse(twiddle.folds_exactly(8, width))
 
 if __name__ == '__main__':
     config.setup_logging(logging.DEBUG)
@@ -0,0 +1,99 @@
+"""
+Quantized twiddle factor tables for the FFT.
+
+The twiddle factors W[k] = exp(-2*pi*i*k/N) for k < N/2 only need
+cos and sin over the first eighth of a turn (N/8+1 values).  The rest
+are found by swapping and negating those values (see
+twiddlefactors_folded.v.t).
+"""
+
+import cmath
+
+import numpy
+
+from fpga_sdrlib.conversions import f_to_sint_array
+
+# The B100 has a Spartan 3A 1400 with 32 18Kbit block RAMs.
+b100_block_ram_bits = 32*18*1024
+
+_tables = {}
+
+def twiddle_table(N, width, clean1=False):
+    """
+    The quantized twiddle factors as used in twiddlefactors.v.t.
+
+    Tables are cached so do not modify the returned arrays.
+
+    Args:
+        N: The FFT length.
+        width: The width of a complex number.
+        clean1: How the values are quantized (see f_to_sint).
+
+    Returns:
+        A (re, im) pair of int64 arrays of length N/2.
+    """
+    key = (N, width, clean1)
+    if key not in _tables:
+        tfs = numpy.array([cmath.exp(-i*2j*cmath.pi/N) for i in range(0, N//2)])
+        _tables[key] = (f_to_sint_array(tfs.real, width//2, clean1),
+                        f_to_sint_array(tfs.imag, width//2, clean1))
+    return _tables[key]
+
+def can_fold(N):
+    return N >= 16 and (N & (N-1)) == 0
+
+def folded_table(N, width, clean1=False):
+    """
+    The values stored in the folded ROM.
+
+    Returns:
+        A (cos, sin) pair of int64 arrays of length N/8+1 where
+        cos[m] = cos(2*pi*m/N) and sin[m] = sin(2*pi*m/N) (quantized).
+    """
+    if not can_fold(N):
+        raise ValueError("Folded twiddle factors need N to be a power of two of at least 16.")
+    re, im = twiddle_table(N, width, clean1)
+    q = N//8
+    return re[:q+1], -im[:q+1]
+
+def unfold(N, cos, sin):
+    """
+    Rebuild the full table from a folded table in the same way as
+    twiddlefactors_folded.v.t does.
+    """
+    q = N//8
+    k = numpy.arange(N//2)
+    region = k // q
+    r = k % q
+    m = numpy.where(region % 2 == 1, q - r, r)
+    c = cos[m]
+    s = sin[m]
+    re = numpy.choose(region, [c, s, -s, -c])
+    im = numpy.choose(region, [-s, -c, -c, -s])
+    return re, im
+
+def folds_exactly(N, width, clean1=False):
+    """
+    Whether the folded ROM reproduces the full table exactly.
+
+    Quantizing sin and cos of complementary angles can in principle
+    round differently, in which case the full table must be used.
+    """
+    if not can_fold(N):
+        return False
+    re, im = twiddle_table(N, width, clean1)
+    f_re, f_im = unfold(N, *folded_table(N, width, clean1))
+    return bool(numpy.all(re == f_re) and numpy.all(im == f_im))
+
+def rom_size(N, width, folded):
+    """
+    The size of the twiddle factor ROM.
+
+    Returns:
+        A tuple (entries, bits).
+    """
+    if folded:
+        entries = N//8+1
+    else:
+        entries = N//2
+    return entries, entries*width
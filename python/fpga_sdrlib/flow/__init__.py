@@ -3,6 +3,8 @@ Utility functions to help with generation and verification of
 verilog message stream code.
 """
 
+import numpy
+
 from fpga_sdrlib.generate import copyfile
 
 blocks = {
@@ -41,3 +43,83 @@ incompatibles = {
     'split':
         ('split.v', 'dut_split.v'),
 }
+
+def read_buffer_stats(fn):
+    """
+    Read the statistics written by buffer_AA and buffer_BB when DEBUG is
+    defined and the simulation is given a +buffer_stats plusarg.
+
+    Returns:
+        A dictionary mapping the hierarchical instance name of each buffer
+        to a dictionary with the keys 'high_water' (the most items in the
+        buffer at once), 'high_water_cycle' and 'overflow_cycle' (None if
+        the buffer did not overflow).
+    """
+    stats = {}
+    f = open(fn, 'r')
+    for line in f:
+        bits = line.split()
+        if not bits:
+            continue
+        instance = bits[0]
+        if instance not in stats:
+            stats[instance] = {'high_water': 0, 'high_water_cycle': None,
+                               'overflow_cycle': None}
+        if bits[1] == 'high_water':
+            high_water = int(bits[2])
+            if high_water > stats[instance]['high_water']:
+                stats[instance]['high_water'] = high_water
+                stats[instance]['high_water_cycle'] = int(bits[3])
+        elif bits[1] == 'overflow':
+            stats[instance]['overflow_cycle'] = int(bits[2])
+        else:
+            raise ValueError("Unknown buffer statistic {0}".format(bits[1]))
+    f.close()
+    return stats
+
+def buffer_occupancy(writes, reads):
+    """
+    The number of items in a buffer after each clock cycle.
+
+    Uses the Lindley recursion q[n] = max(q[n-1] + writes[n] - reads[n], 0)
+    so reads from an empty buffer are ignored.  An item written and read
+    in the same cycle is treated as passing straight through (the real
+    buffers add a cycle of latency).
+
+    Args:
+        writes: The number of items written in each cycle.
+        reads: The number of items the reader wants in each cycle.
+    """
+    change = (numpy.asarray(writes, dtype=numpy.int64) -
+              numpy.asarray(reads, dtype=numpy.int64))
+    total = numpy.concatenate(([0], numpy.cumsum(change)))
+    return (total - numpy.minimum.accumulate(total))[1:]
+
+def recommend_mem_size(writes=None, reads=None, high_water=None, margin=1.0):
+    """
+    Recommend a MEM_SIZE for a buffer.
+
+    Either give the burst profile (writes and reads as for
+    buffer_occupancy) or a high water mark measured in simulation (see
+    read_buffer_stats).
+
+    Args:
+        margin: The occupancy is multiplied by this before rounding.
+
+    Returns:
+        The smallest power of two (as the buffer addresses must wrap)
+        that holds the largest occupancy.
+    """
+    if high_water is None:
+        if writes is None or reads is None:
+            raise ValueError("Need either writes and reads or high_water.")
+        occupancy = buffer_occupancy(writes, reads)
+        if len(occupancy):
+            high_water = int(occupancy.max())
+        else:
+            high_water = 0
+    needed = max(int(numpy.ceil(high_water*margin)), 2)
+    mem_size = 2
+    while mem_size < needed:
+        mem_size *= 2
+    return mem_size
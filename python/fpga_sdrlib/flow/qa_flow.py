@@ -9,6 +9,7 @@ import shutil
 
 from fpga_sdrlib.generate import logceil
 from fpga_sdrlib import config, b100, buildutils
+from fpga_sdrlib.flow import buffer_occupancy, recommend_mem_size
 from fpga_sdrlib.testbench import TestBenchB100, TestBenchIcarusOuter
 
 logger = logging.getLogger(__name__)
@@ -169,23 +170,61 @@ class TestBuffer(unittest.TestCase):
              'WRITEERRORCODE': 666,
              'READERRORCODE': 777,
              })
+        debug_defines = config.updated_defines(defines)
+        debug_defines['DEBUG'] = True
         executable = buildutils.generate_icarus_executable(
-            'flow', 'buffer_AA_burst', '-test', defines=defines)
+            'flow', 'buffer_AA_burst', '-test', defines=debug_defines)
         fpgaimage = buildutils.generate_B100_image(
             'flow', 'buffer_AA_burst', '-test', defines=defines)
         tb_icarus = TestBenchIcarusOuter(executable, in_raw=data,
                                          output_msgs=False)
         tb_b100 = TestBenchB100(fpgaimage, in_raw=data, output_msgs=False)
-        for tb, steps in (
-                (tb_icarus, steps_rqd),
-                (tb_b100, 100000), 
+        for tb, steps, kwargs in (
+                (tb_icarus, steps_rqd, {'buffer_stats': True}),
+                (tb_b100, 100000, {}), 
                 ):
-            tb.run(steps)
+            tb.run(steps, **kwargs)
             # Confirm that our data is correct.
             stream = None
             self.assertEqual(len(tb.out_raw), len(data))
             for r, e in zip(tb.out_raw, data):
                 self.assertEqual(e, r)
+        # Check how full the buffer got.
+        self.assertEqual(len(tb_icarus.buffer_stats), 1)
+        stats = tb_icarus.buffer_stats.values()[0]
+        logger.debug("buffer_AA_burst high water mark is {0}".format(stats['high_water']))
+        self.assertTrue(stats['overflow_cycle'] is None)
+        self.assertTrue(0 < stats['high_water'] <= buffer_length)
+        self.assertTrue(recommend_mem_size(high_water=stats['high_water']) <= buffer_length)
+
+class TestBufferSizing(unittest.TestCase):
+
+    def test_occupancy(self):
+        """
+        Compare buffer_occupancy with a loop.
+        """
+        writes = [random.randint(0, 1) for i in range(200)]
+        reads = [random.randint(0, 1) for i in range(200)]
+        expected = []
+        q = 0
+        for w, r in zip(writes, reads):
+            q = max(q + w - r, 0)
+            expected.append(q)
+        self.assertEqual(list(buffer_occupancy(writes, reads)), expected)
+
+    def test_recommend(self):
+        """
+        A burst of 20 writes is read out at half the rate.
+        """
+        writes = [1]*20 + [0]*40
+        reads = [0, 1]*30
+        # After the burst 10 have been read so 10 are left.
+        self.assertEqual(max(buffer_occupancy(writes, reads)), 10)
+        self.assertEqual(recommend_mem_size(writes, reads), 16)
+        self.assertEqual(recommend_mem_size(writes, reads, margin=2), 32)
+        self.assertEqual(recommend_mem_size(high_water=32), 32)
+        self.assertEqual(recommend_mem_size(high_water=0), 2)
+        self.assertRaises(ValueError, recommend_mem_size, writes)
 
 if __name__ == '__main__':
     config.setup_logging(logging.DEBUG)
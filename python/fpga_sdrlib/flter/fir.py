@@ -0,0 +1,163 @@
+"""
+Python model of filter.v to test the verilog against.
+
+The model reproduces the integer arithmetic of summult.v (each product
+goes through multiply.v and the sum wraps at WIDTH/2 bits) so the
+output is bit-exact.  Complex values are passed around as a pair
+(re, im) of int64 arrays holding the signed components.
+
+plan_taps prepares the taps of a filterbank from a prototype filter.
+"""
+
+import hashlib
+
+import numpy
+
+from fpga_sdrlib import config
+from fpga_sdrlib.conversions import f_to_sint_array
+
+def wrap(xs, width):
+    """
+    Keep the lowest `width` bits of signed integers.
+    """
+    offset = pow(2, width-1)
+    return ((xs + offset) & (pow(2, width)-1)) - offset
+
+def quantize_taps(taps, width=config.default_width):
+    """
+    The tap values that filter.v receives from taps_to_start_msgs.
+
+    Args:
+        taps: Float taps between -1 and 1.
+        width: The width of a complex number.
+    """
+    return f_to_sint_array(taps, width//2, clean1=True)
+
+class FixedFilter(object):
+    """
+    A bit-exact model of filter.v.
+
+    Samples can be passed in chunks.  The last FLTLEN-1 samples are kept
+    between chunks (as in the history register of filter.v).
+
+    Args:
+        taps: The quantized taps (see quantize_taps).  taps[0] multiplies
+            the newest sample.
+        width: The width of a complex number.
+    """
+
+    def __init__(self, taps, width=config.default_width):
+        self.taps = numpy.asarray(taps, dtype=numpy.int64)
+        self.width = width
+        self.history_re = numpy.zeros(len(self.taps)-1, dtype=numpy.int64)
+        self.history_im = numpy.zeros(len(self.taps)-1, dtype=numpy.int64)
+
+    def filter_component(self, history, xs):
+        cw = self.width//2
+        n_taps = len(self.taps)
+        extended = numpy.concatenate((history, xs))
+        total = numpy.zeros(len(xs), dtype=numpy.int64)
+        for i, tap in enumerate(self.taps.tolist()):
+            start = n_taps-1-i
+            # Each product is done by multiply.v.
+            total += wrap((extended[start: start+len(xs)] * tap) >> (cw-1), cw)
+        new_history = extended[len(extended)-(n_taps-1):]
+        return wrap(total, cw), new_history
+
+    def process(self, data):
+        """
+        Filter a chunk of samples.
+
+        Args:
+            data: A (re, im) pair of arrays of signed integers.
+
+        Returns:
+            A (re, im) pair with one output for each input.
+        """
+        re = numpy.asarray(data[0], dtype=numpy.int64)
+        im = numpy.asarray(data[1], dtype=numpy.int64)
+        out_re, self.history_re = self.filter_component(self.history_re, re)
+        out_im, self.history_im = self.filter_component(self.history_im, im)
+        return out_re, out_im
+
+def fixed_filter(taps, data, width=config.default_width):
+    """
+    Filter a whole stream of samples with filter.v's arithmetic.
+    """
+    return FixedFilter(taps, width).process(data)
+
+class TapPlan(object):
+    """
+    The quantized taps for a filterbank.
+
+    Plans are shared by plan_taps so the arrays are read-only.
+
+    Attributes:
+        taps: An (n_chans, taps_per_chan) int64 array of signed taps.
+        worst_case: For each channel the largest magnitude the summult
+            sum can reach for any input.
+        limit: The largest magnitude the WIDTH/2 bit sum can hold.
+        headroom_bits: How many bits of growth are left in the worst
+            channel (negative if it can overflow).
+    """
+
+    def __init__(self, taps, width):
+        self.taps = taps
+        self.width = width
+        # A product from multiply.v has a magnitude of at most |tap|.
+        self.worst_case = numpy.abs(taps).sum(axis=1)
+        self.limit = pow(2, width//2-1)-1
+        worst = max(int(self.worst_case.max()), 1)
+        self.headroom_bits = numpy.log2(float(self.limit)/worst)
+        self.taps.flags.writeable = False
+        self.worst_case.flags.writeable = False
+
+    @property
+    def overflow(self):
+        return bool(self.worst_case.max() > self.limit)
+
+    def contents(self):
+        """
+        The taps as unsigned integers ready to put in a start message.
+        """
+        mask = pow(2, self.width//2)-1
+        return (self.taps.flatten() & mask).tolist()
+
+tap_plan_cache = {}
+
+def plan_taps(taps, n_chans, width=config.default_width, reverse=True,
+              check=True):
+    """
+    Split a prototype filter into per-channel quantized taps.
+
+    The taps are padded with zeros to a multiple of n_chans and channel i
+    gets taps[i::n_chans] (reversed if `reverse` as in
+    channelizer.build.make_taps).  Results are cached.
+
+    Args:
+        taps: The prototype filter (floats between -1 and 1).
+        n_chans: Number of channels.
+        width: The width of a complex number.
+        reverse: Whether to reverse the taps in each channel.
+        check: Raise a ValueError if a channel's sum can overflow.
+
+    Returns:
+        A TapPlan.
+    """
+    taps = numpy.asarray(taps, dtype=float)
+    key = (hashlib.sha1(taps.tobytes()).hexdigest(), n_chans, width, reverse)
+    if key in tap_plan_cache:
+        plan = tap_plan_cache[key]
+    else:
+        taps_per_chan = -(-len(taps) // n_chans)
+        padded = numpy.zeros(taps_per_chan*n_chans)
+        padded[:len(taps)] = taps
+        chantaps = padded.reshape(taps_per_chan, n_chans).transpose()
+        if reverse:
+            chantaps = chantaps[:, ::-1]
+        plan = TapPlan(quantize_taps(chantaps, width), width)
+        tap_plan_cache[key] = plan
+    if check and plan.overflow:
+        raise ValueError("Summed taps can overflow (worst case {0} but maximum is {1}).".format(
+                plan.worst_case.max(), plan.limit))
+    return plan
@@ -7,11 +7,17 @@ import unittest
 import logging
 import shutil
 
+import numpy
+
 from fpga_sdrlib.message import msg_utils
-from fpga_sdrlib.conversions import f_to_int
+from fpga_sdrlib.conversions import f_to_int, int_to_sint
 from fpga_sdrlib.generate import logceil
 from fpga_sdrlib import config, b100, buildutils
 from fpga_sdrlib.testbench import TestBenchB100, TestBenchIcarusInner, TestBenchIcarusOuter
+from fpga_sdrlib.flter.fir import FixedFilter, fixed_filter, quantize_taps, plan_taps
+from fpga_sdrlib.fft.dit import to_fixed, raw_to_fixed
+from fpga_sdrlib.timing import TimingReport
+from fpga_sdrlib import sweep
 
 logger = logging.getLogger(__name__)
 
@@ -88,16 +94,56 @@ class TestFilter(unittest.TestCase):
         tb_icarus_inner = TestBenchIcarusInner(executable_inner, in_samples, in_ms, start_msgs)
         tb_icarus_outer = TestBenchIcarusOuter(executable_outer, in_samples, start_msgs)
         tb_b100 = TestBenchB100(fpgaimage, in_samples, start_msgs)
-        for tb, steps in (
-                (tb_icarus_inner, steps_rqd),
-                (tb_icarus_outer, steps_rqd),
-                (tb_b100, 100000), 
+        for tb, steps, kwargs in (
+                (tb_icarus_inner, steps_rqd, {'instrument': True}),
+                (tb_icarus_outer, steps_rqd, {'instrument': True}),
+                (tb_b100, 100000, {}), 
                 ):
-            tb.run(steps)
+            tb.run(steps, **kwargs)
             # Confirm that our data is correct.
             self.assertEqual(len(tb.out_samples), len(expected))
             for r, e in zip(tb.out_samples, expected):
                 self.assertAlmostEqual(e, r, 3)
+        # The fixed point model must match the verilog exactly.
+        e_re, e_im = fixed_filter(quantize_taps(taps, width),
+                                  to_fixed(in_samples, width), width)
+        r_re, r_im = raw_to_fixed(tb_icarus_inner.out_raw, width)
+        self.assertEqual(r_re.tolist(), e_re.tolist())
+        self.assertEqual(r_im.tolist(), e_im.tolist())
+        # The filter produces one output for each input so should keep up.
+        for tb in (tb_icarus_inner, tb_icarus_outer):
+            self.assertEqual(len(tb.timing.latencies), len(expected))
+            self.assertTrue(min(tb.timing.latencies) > 0)
+            self.assertEqual(tb.timing.bubbles, 0)
+
+class TestFilterSweep(unittest.TestCase):
+
+    def test_one(self):
+        """
+        Find the smallest sendnth the filter module works with.
+        """
+        filter_length = 4
+        filter_id = 123
+        taps = [random.random()*2-1 for i in range(filter_length)]
+        total = sum([abs(t) for t in taps])
+        taps = [t/total for t in taps]
+        n_data = 40
+        in_samples = [random.random()*2-1 + random.random()*2j-1j for i in range(n_data)]
+        in_samples += [0]*(filter_length-1)
+        expected = convolve(in_samples, taps)
+        defines = config.updated_defines(
+            {'FILTER_LENGTH': filter_length,
+             'FILTER_ID': filter_id,
+             })
+        start_msgs = taps_to_start_msgs(taps, defines['WIDTH']/2, filter_id)
+        configurations = [
+            sweep.Configuration('flter', 'filter', in_samples, expected,
+                                start_msgs=start_msgs, defines=defines,
+                                extraargs={'summult_length': filter_length})]
+        results = sweep.sweep(configurations, max_sendnth=8)
+        # The other tests use the default sendnth so it had better work.
+        self.assertTrue(results[0].min_sendnth is not None)
+        self.assertTrue(results[0].min_sendnth <= config.default_sendnth)
 
 class TestFilterBank(unittest.TestCase):
 
@@ -187,6 +233,96 @@ class TestFilterBank(unittest.TestCase):
                     matched_once = True
             self.assertTrue(matched_once)
 
+class TestFixedFilter(unittest.TestCase):
+
+    def setUp(self):
+        self.rg = random.Random(0)
+
+    def test_fixed_filter(self):
+        """
+        Compare the fixed point filter model with a scalar calculation.
+        """
+        width = config.default_width
+        cw = width/2
+        filter_length = 5
+        taps = [self.rg.random()*2-1 for i in range(filter_length)]
+        total = sum([abs(t) for t in taps])
+        taps = [t/total for t in taps]
+        qtaps = quantize_taps(taps, width)
+        # The same values as sent by taps_to_start_msgs.
+        self.assertEqual(list(qtaps), [int_to_sint(f_to_int(t, cw, clean1=True), cw)
+                                       for t in taps])
+        def wrap(x):
+            return (x + pow(2, cw-1)) % pow(2, cw) - pow(2, cw-1)
+        n_data = 100
+        xs = [self.rg.randint(-pow(2, cw-1), pow(2, cw-1)-1) for i in range(n_data)]
+        padded = [0]*(filter_length-1) + xs
+        expected = []
+        for n in range(n_data):
+            v = 0
+            for i, tap in enumerate(qtaps):
+                v += wrap((padded[n+filter_length-1-i] * int(tap)) >> (cw-1))
+            expected.append(wrap(v))
+        out_re, out_im = fixed_filter(qtaps, (xs, xs[::-1]), width)
+        self.assertEqual(list(out_re), expected)
+        # Feeding the data in chunks gives the same result.
+        flt = FixedFilter(qtaps, width)
+        chunked_re = []
+        chunked_im = []
+        for start, stop in ((0, 2), (2, 3), (3, 50), (50, 100)):
+            re, im = flt.process((xs[start:stop], xs[::-1][start:stop]))
+            chunked_re.extend(re)
+            chunked_im.extend(im)
+        self.assertEqual(chunked_re, list(out_re))
+        self.assertEqual(chunked_im, list(out_im))
+
+    def test_plan_taps(self):
+        """
+        Test splitting a prototype filter between channels.
+        """
+        width = config.default_width
+        n_chans = 4
+        taps = [self.rg.random()*0.2-0.1 for i in range(18)]
+        plan = plan_taps(taps, n_chans, width)
+        self.assertEqual(plan.taps.shape, (n_chans, 5))
+        padded = taps + [0]*2
+        for i in range(n_chans):
+            expected = list(reversed(padded[i::n_chans]))
+            self.assertEqual(list(plan.taps[i]), list(quantize_taps(expected, width)))
+        self.assertFalse(plan.overflow)
+        self.assertTrue(plan.headroom_bits > 0)
+        self.assertEqual(len(plan.contents()), n_chans*5)
+        # Plans are cached and shared so they cannot be changed.
+        self.assertTrue(plan_taps(taps, n_chans, width) is plan)
+        def modify():
+            plan.taps[0, 0] = 1
+        self.assertRaises(ValueError, modify)
+        # Large taps can overflow the sum.
+        self.assertRaises(ValueError, plan_taps, [0.9]*8, 2, width)
+
+class TestTimingReport(unittest.TestCase):
+
+    def test_report(self):
+        """
+        Test the timing statistics on made up cycles.
+        """
+        sendnth = 3
+        in_cycles = range(10, 100, sendnth+1)
+        # A latency of 5 with one output delayed by 3 cycles.
+        out_cycles = [c+5 for c in in_cycles]
+        out_cycles[10] += 3
+        report = TimingReport(in_cycles, out_cycles, sendnth, window=4)
+        self.assertEqual(min(report.latencies), 5)
+        self.assertEqual(max(report.latencies), 8)
+        self.assertEqual(report.bubbles, 1)
+        self.assertEqual(report.stall_cycles, 3)
+        self.assertEqual(report.max_backlog, 3)
+        self.assertAlmostEqual(report.samples_per_clock, 1.0/(sendnth+1))
+        self.assertEqual(report.min_sendnth, sendnth)
+        summary = report.to_dict()
+        self.assertEqual(summary['n_out'], len(in_cycles))
+        self.assertEqual(summary['latency']['median'], 5)
+
 if __name__ == '__main__':
     config.setup_logging(logging.DEBUG)
     #suite = unittest.TestLoader().loadTestsFromTestCase(TestFilterBank)
@@ -6,12 +6,14 @@ import random
 import unittest
 import logging
 import shutil
+import tempfile
 
 from fpga_sdrlib.message import msg_utils
 from fpga_sdrlib.conversions import f_to_int
 from fpga_sdrlib.generate import logceil
 from fpga_sdrlib import config, b100, buildutils
 from fpga_sdrlib.testbench import TestBenchB100, TestBenchIcarusInner, TestBenchIcarusOuter
+from fpga_sdrlib.testbench import run_testbenches
 
 logger = logging.getLogger(__name__)
 
@@ -40,17 +42,122 @@ class TestMultiply(unittest.TestCase):
         tb_icarus_outer = TestBenchIcarusOuter(executable_outer, in_samples,
                                                sendnth=sendnth)
         tb_b100 = TestBenchB100(fpgaimage, in_samples)
-        for tb, steps, check_ms in (
-                (tb_icarus_inner, steps_rqd, True),
-                (tb_icarus_outer, steps_rqd, False),
-                (tb_b100, 100000, False), 
-                ):
-            tb.run(steps)
+        # The icarus simulations are independent so run them together.
+        run_testbenches([(tb_icarus_inner, steps_rqd),
+                         (tb_icarus_outer, steps_rqd)])
+        tb_b100.run(100000)
+        for tb in (tb_icarus_inner, tb_icarus_outer, tb_b100):
             # Confirm that our data is correct.
             self.assertEqual(len(tb.out_samples), len(expected))
             for r, e in zip(tb.out_samples, expected):
                 self.assertAlmostEqual(e, r, 3)
 
+class TestIcarusExecutables(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix='icarus_')
+        self.old_cachedir = buildutils.icarus_cachedir
+        self.old_inputsdir = buildutils.icarus_inputsdir
+        buildutils.icarus_cachedir = os.path.join(self.tmpdir, 'cache')
+        buildutils.icarus_inputsdir = os.path.join(self.tmpdir, 'inputs')
+
+    def tearDown(self):
+        buildutils.icarus_cachedir = self.old_cachedir
+        buildutils.icarus_inputsdir = self.old_inputsdir
+        shutil.rmtree(self.tmpdir)
+
+    def test_batch(self):
+        """
+        Compile a batch of executables and then get them from the cache.
+        """
+        defines = config.default_defines
+        requests = [('fpgamath', 'multiply_inner', '-batch1', defines, {}),
+                    ('fpgamath', 'multiply_inner', '-batch2', defines, {}),
+                    ('fpgamath', 'multiply', '-batch', defines, {}),
+                    # A repeated request gives the same executable.
+                    ('fpgamath', 'multiply', '-batch', defines, {})]
+        builds = buildutils.generate_icarus_executables(requests, processes=2)
+        executables = [b.get() for b in builds]
+        for b in builds:
+            self.assertFalse(isinstance(b, buildutils.FinishedBuild))
+        self.assertEqual(executables[2], executables[3])
+        self.assertEqual(len(set(executables)), 3)
+        for executable, (package, name, suffix, d, e) in zip(executables, requests):
+            self.assertEqual(os.path.basename(executable), name + suffix)
+            self.assertTrue(os.path.exists(executable))
+        # The two multiply_inner builds have the same hash.
+        self.assertEqual(len(os.listdir(buildutils.icarus_cachedir)), 2)
+        # The copied inputs are removed once compiled.
+        self.assertEqual(os.listdir(buildutils.icarus_inputsdir), [])
+        hits = buildutils.icarus_cache_stats['hits']
+        for executable in set(executables):
+            os.remove(executable)
+        builds = buildutils.generate_icarus_executables(requests, processes=2)
+        for b, executable in zip(builds, executables):
+            self.assertTrue(isinstance(b, buildutils.FinishedBuild))
+            self.assertEqual(b.get(), executable)
+            self.assertTrue(os.path.exists(executable))
+        self.assertEqual(buildutils.icarus_cache_stats['hits'], hits+3)
+        self.assertEqual(os.listdir(buildutils.icarus_inputsdir), [])
+        # Different builds of the same executable cannot be requested.
+        other_defines = config.updated_defines({'DEBUG': True})
+        self.assertRaises(
+            ValueError, buildutils.generate_icarus_executables,
+            [('fpgamath', 'multiply', '-batch', defines, {}),
+             ('fpgamath', 'multiply', '-batch', other_defines, {})])
+
+class TestRunTestbenches(unittest.TestCase):
+
+    def test_copy_back(self):
+        """
+        Testbenches run in the pool get the same output attributes as
+        testbenches run directly.
+        """
+        sendnth = 2
+        n_data = 20
+        in_samples = [random.random()*2-1 + random.random()*2j-1j for i in range(n_data)]
+        steps_rqd = len(in_samples)*sendnth*2 + 100
+        executable_inner = buildutils.generate_icarus_executable(
+            'fpgamath', 'multiply_inner', '-test',)
+        executable_outer = buildutils.generate_icarus_executable(
+            'fpgamath', 'multiply', '-test',)
+        pooled = [TestBenchIcarusInner(executable_inner, in_samples, sendnth=sendnth),
+                  TestBenchIcarusOuter(executable_outer, in_samples, sendnth=sendnth)]
+        direct = [TestBenchIcarusInner(executable_inner, in_samples, sendnth=sendnth),
+                  TestBenchIcarusOuter(executable_outer, in_samples, sendnth=sendnth)]
+        signals = [tb.out_data for tb in pooled]
+        tbs = run_testbenches([(tb, steps_rqd) for tb in pooled], processes=2)
+        self.assertEqual(tbs, pooled)
+        for tb in direct:
+            tb.run(steps_rqd)
+        for p, d, signal in zip(pooled, direct, signals):
+            self.assertTrue(p.run_error is None)
+            self.assertEqual(len(p.out_samples), n_data)
+            self.assertEqual(p.out_raw, d.out_raw)
+            self.assertEqual(p.out_samples, d.out_samples)
+            self.assertEqual(p.out_messages, d.out_messages)
+            self.assertEqual(p.cycles_used, d.cycles_used)
+            # The Signals stay as they were.
+            self.assertTrue(p.out_data is signal)
+        self.assertEqual(pooled[0].out_ms, direct[0].out_ms)
+        self.assertEqual(pooled[0].out_msgs, direct[0].out_msgs)
+
+    def test_timing(self):
+        """
+        The timing of an instrumented run is copied back from the pool.
+        """
+        sendnth = 2
+        n_data = 20
+        in_samples = [random.random()*2-1 + random.random()*2j-1j for i in range(n_data)]
+        steps_rqd = len(in_samples)*sendnth*2 + 100
+        executable_inner = buildutils.generate_icarus_executable(
+            'fpgamath', 'multiply_inner', '-test',)
+        tb = TestBenchIcarusInner(executable_inner, in_samples, sendnth=sendnth)
+        run_testbenches([(tb, steps_rqd, {'instrument': True})])
+        self.assertEqual(len(tb.in_cycles), n_data)
+        self.assertEqual(len(tb.out_cycles), n_data)
+        self.assertEqual(len(tb.timing.latencies), n_data)
+
 class TestMultiplyComplex(unittest.TestCase):
 
     def test_one(self):
@@ -82,12 +189,11 @@ class TestMultiplyComplex(unittest.TestCase):
         tb_icarus_outer = TestBenchIcarusOuter(executable_outer, in_samples,
                                                sendnth=sendnth)
         tb_b100 = TestBenchB100(fpgaimage, in_samples)
-        for tb, steps, check_ms in (
-                (tb_icarus_inner, steps_rqd, True),
-                (tb_icarus_outer, steps_rqd, False),
-                (tb_b100, 100000, False), 
-                ):
-            tb.run(steps)
+        # The icarus simulations are independent so run them together.
+        run_testbenches([(tb_icarus_inner, steps_rqd),
+                         (tb_icarus_outer, steps_rqd)])
+        tb_b100.run(100000)
+        for tb in (tb_icarus_inner, tb_icarus_outer, tb_b100):
             # Confirm that our data is correct.
             self.assertEqual(len(tb.out_samples), len(expected))
             for r, e in zip(tb.out_samples, expected):
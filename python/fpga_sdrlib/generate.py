@@ -1,8 +1,10 @@
 import shutil
 import os
 import math
+import json
+import hashlib
 
-from jinja2 import Environment, FileSystemLoader
+from jinja2 import Environment, FileSystemLoader, FileSystemBytecodeCache
 
 from fpga_sdrlib import config
 
@@ -24,13 +26,64 @@ def copyfile(directory, name, dependencies, extraargs={}):
     dep_extraargs = dict([(d, extraargs) for d in dependencies])
     return out_fn, dep_extraargs
 
+jinja_cachedir = os.path.join(config.builddir, 'jinja_cache')
+_environment = None
+
+def get_environment():
+    """
+    Returns the jinja2 environment shared by all template rendering.
+    Compiled templates are cached on disk between runs.
+    """
+    global _environment
+    if _environment is None:
+        if not os.path.exists(jinja_cachedir):
+            os.makedirs(jinja_cachedir)
+        _environment = Environment(
+            loader=FileSystemLoader(config.verilogdir),
+            bytecode_cache=FileSystemBytecodeCache(jinja_cachedir),
+            auto_reload=True)
+    return _environment
+
+def template_key(template_fn, template_args):
+    """
+    A hash of a template's source and the arguments it is rendered with.
+    """
+    h = hashlib.sha1()
+    f = open(template_fn, 'rb')
+    h.update(f.read())
+    f.close()
+    h.update(json.dumps(template_args, sort_keys=True, default=repr))
+    return h.hexdigest()
+
 def format_template(template_fn, output_fn, template_args):
     """
     Formats a template.
+
+    A file recording a key of the template and arguments, and a hash of
+    the output, is written alongside the output.  If the output still
+    matches and the key is unchanged then the template is not rendered
+    again.
     """
-    env = Environment(loader=FileSystemLoader(config.verilogdir))
+    key = template_key(template_fn, template_args)
+    key_fn = output_fn + '.key'
+    if os.path.exists(output_fn) and os.path.exists(key_fn):
+        f = open(key_fn, 'r')
+        old_key = f.read()
+        f.close()
+        f = open(output_fn, 'rb')
+        output_hash = hashlib.sha1(f.read()).hexdigest()
+        f.close()
+        if old_key == key + ' ' + output_hash:
+            return
+    env = get_environment()
     template = env.get_template(os.path.relpath(template_fn, config.verilogdir))
+    output = template.render(**template_args)
     f_out = open(output_fn, 'w')
-    f_out.write(template.render(**template_args))
+    f_out.write(output)
     f_out.close()
-
+    f = open(output_fn, 'rb')
+    output_hash = hashlib.sha1(f.read()).hexdigest()
+    f.close()
+    f = open(key_fn, 'w')
+    f.write(key + ' ' + output_hash)
+    f.close()
@@ -0,0 +1,233 @@
+"""
+A cycle-level python model of message_stream_combiner.v.
+
+The model reproduces the input buffering (buffer_AA.v), the round-robin
+arbitration between streams and the output ordering of the verilog so
+that long random streams can be checked without running a simulator.
+Cycles in which nothing can happen are skipped.
+"""
+
+import numpy
+
+from fpga_sdrlib.config import msg_length_width, msg_width
+
+class MessageStreamCombinerModel(object):
+    """
+    Models message_stream_combiner.v one clock cycle at a time.
+
+    Register updates follow the verilog, so values written in a cycle
+    are only seen by the other modules in the following cycle.
+
+    Args:
+        n_streams: N_STREAMS
+        width: WIDTH
+        input_buffer_length: INPUT_BUFFER_LENGTH (a power of two)
+        log_max_packet_length: LOG_MAX_PACKET_LENGTH
+    """
+
+    def __init__(self, n_streams, width=msg_width, input_buffer_length=64,
+                 log_max_packet_length=msg_length_width):
+        self.n_streams = n_streams
+        self.width = width
+        self.mem_size = input_buffer_length
+        self.log_max_packet_length = log_max_packet_length
+        self.length_shift = width-1-log_max_packet_length
+        self.length_mask = pow(2, log_max_packet_length)-1
+        # buffer_AA state
+        self.rams = [[0]*self.mem_size for i in range(n_streams)]
+        self.fulls = [[False]*self.mem_size for i in range(n_streams)]
+        self.occupancies = [0]*n_streams
+        self.write_addrs = [0]*n_streams
+        self.read_addrs = [0]*n_streams
+        self.read_fulls = [False]*n_streams
+        self.read_datas = [0]*n_streams
+        self.write_error = False
+        self.read_error = False
+        # message_stream_combiner state
+        self.stream = 0
+        self.read_deletes = 0
+        self.packet_pos = 0
+        self.packet_length = 0
+        self.cycle = 0
+
+    @property
+    def error(self):
+        return self.write_error or self.read_error
+
+    def idle(self):
+        """
+        Whether the model will do nothing until new input arrives.
+        """
+        return (self.read_deletes == 0 and not any(self.read_fulls)
+                and not any(self.occupancies))
+
+    def skip(self, n_cycles):
+        """
+        Advance an idle model by n_cycles.
+        """
+        assert(self.idle())
+        if self.packet_pos == 0:
+            self.stream = (self.stream + n_cycles) % self.n_streams
+        self.cycle += n_cycles
+
+    def step(self, in_nd=0, in_data=None):
+        """
+        Advance the model by one clock cycle.
+
+        Args:
+            in_nd: Bit i is set if stream i has new data.
+            in_data: A sequence with the data for each stream.
+
+        Returns:
+            The output data or None if out_nd is low.
+        """
+        # The combiner sees the buffer outputs from the previous cycle.
+        stream = self.stream
+        old_deletes = self.read_deletes
+        out = None
+        if not (old_deletes >> stream) & 1 and self.read_fulls[stream]:
+            self.read_deletes = 1 << stream
+            out = self.read_datas[stream]
+            if self.packet_pos == 0:
+                if out >> (self.width-1):
+                    length = (out >> self.length_shift) & self.length_mask
+                    self.packet_length = length
+                    if length != 0:
+                        self.packet_pos = 1
+            elif self.packet_pos == self.packet_length:
+                self.packet_pos = 0
+            else:
+                self.packet_pos = (self.packet_pos + 1) & self.length_mask
+        else:
+            if self.packet_pos == 0:
+                if stream == self.n_streams-1:
+                    self.stream = 0
+                else:
+                    self.stream = stream + 1
+            self.read_deletes = 0
+        # The buffers see the read_deletes from the previous cycle.
+        for i in range(self.n_streams):
+            full = self.fulls[i]
+            ram = self.rams[i]
+            read_addr = self.read_addrs[i]
+            cleared = None
+            if (old_deletes >> i) & 1 and full[read_addr]:
+                cleared = read_addr
+                read_addr = (read_addr + 1) % self.mem_size
+                self.read_addrs[i] = read_addr
+            elif (old_deletes >> i) & 1:
+                self.read_error = True
+            self.read_fulls[i] = full[read_addr]
+            self.read_datas[i] = ram[read_addr]
+            if (in_nd >> i) & 1:
+                write_addr = self.write_addrs[i]
+                if not full[write_addr]:
+                    ram[write_addr] = in_data[i]
+                    full[write_addr] = True
+                    self.occupancies[i] += 1
+                    self.write_addrs[i] = (write_addr + 1) % self.mem_size
+                else:
+                    self.write_error = True
+            if cleared is not None:
+                full[cleared] = False
+                self.occupancies[i] -= 1
+        self.cycle += 1
+        return out
+
+    def run(self, in_cycles, in_nds, in_datas, max_cycles=None):
+        """
+        Feed inputs into the model and run it until it is idle (or stuck
+        in the middle of a packet).
+
+        Args:
+            in_cycles: The cycles on which there is new data (increasing).
+            in_nds: The in_nd value for each of those cycles.
+            in_datas: An array of shape (len(in_cycles), n_streams) with
+                the data for each stream.
+            max_cycles: Stop after this cycle even if not idle.
+
+        Returns:
+            A tuple (out_datas, out_cycles) of uint64 and int64 arrays.
+        """
+        in_cycles = numpy.asarray(in_cycles, dtype=numpy.int64).tolist()
+        in_nds = numpy.asarray(in_nds, dtype=numpy.int64).tolist()
+        in_datas = numpy.asarray(in_datas, dtype=numpy.uint64).tolist()
+        out_datas = []
+        out_cycles = []
+        pos = 0
+        # Once all the input has been sent the model must output something
+        # every few cycles unless it is stuck waiting for the rest of a
+        # packet that will never arrive.
+        stuck_cycles = 2*self.n_streams + 2
+        last_active_cycle = self.cycle
+        while max_cycles is None or self.cycle < max_cycles:
+            if (pos == len(in_cycles) and
+                self.cycle - last_active_cycle > stuck_cycles):
+                break
+            if pos < len(in_cycles) and in_cycles[pos] == self.cycle:
+                out = self.step(in_nds[pos], in_datas[pos])
+                pos += 1
+                last_active_cycle = self.cycle
+            elif self.idle():
+                if pos == len(in_cycles):
+                    break
+                next_cycle = in_cycles[pos]
+                if max_cycles is not None:
+                    next_cycle = min(next_cycle, max_cycles)
+                self.skip(next_cycle - self.cycle)
+                continue
+            else:
+                out = self.step()
+            if out is not None:
+                out_datas.append(out)
+                out_cycles.append(self.cycle-1)
+                last_active_cycle = self.cycle
+        return (numpy.array(out_datas, dtype=numpy.uint64),
+                numpy.array(out_cycles, dtype=numpy.int64))
+
+def schedule_inputs(streams, sendnth):
+    """
+    Work out the inputs the combiner receives from a testbench.
+
+    A row of inputs is sent every sendnth+1 cycles, starting at cycle
+    sendnth, as in TestBenchMessageStreamCombiner.
+
+    Args:
+        streams: A list of the data for each stream.  None means that
+            nothing is sent on that stream in that row.  Streams are
+            padded with None to the same length.
+        sendnth: The spacing between rows.
+
+    Returns:
+        A tuple (in_cycles, in_nds, in_datas) for
+        MessageStreamCombinerModel.run.
+    """
+    n_streams = len(streams)
+    n_rows = max([len(s) for s in streams])
+    in_datas = numpy.zeros((n_rows, n_streams), dtype=numpy.uint64)
+    in_nds = numpy.zeros(n_rows, dtype=numpy.int64)
+    for i, s in enumerate(streams):
+        present = numpy.array([d is not None for d in s], dtype=bool)
+        values = numpy.array([0 if d is None else d for d in s],
+                             dtype=numpy.uint64)
+        in_datas[:len(s), i] = values
+        in_nds[:len(s)] += present.astype(numpy.int64) << i
+    in_cycles = sendnth + numpy.arange(n_rows, dtype=numpy.int64) * (sendnth+1)
+    # Rows with nothing in them are not inputs.
+    keep = in_nds != 0
+    return in_cycles[keep], in_nds[keep], in_datas[keep]
+
+def combine_streams(streams, sendnth, width=msg_width, input_buffer_length=64,
+                    log_max_packet_length=msg_length_width):
+    """
+    Model message_stream_combiner.v combining a number of streams.
+
+    Returns:
+        A tuple (out_datas, error) where out_datas is a uint64 array of
+        the output and error is True if a buffer overflowed.
+    """
+    model = MessageStreamCombinerModel(
+        len(streams), width, input_buffer_length, log_max_packet_length)
+    in_cycles, in_nds, in_datas = schedule_inputs(streams, sendnth)
+    out_datas, out_cycles = model.run(in_cycles, in_nds, in_datas)
+    return out_datas, model.error
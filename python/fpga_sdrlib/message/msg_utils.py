@@ -1,5 +1,7 @@
 import random
 
+import numpy
+
 from fpga_sdrlib.config import msg_length_width, msg_width, msg_errorcode_width
 
 def generate_header(length, bits_for_length, width, target=None):
@@ -50,63 +52,234 @@ def generate_random_packets(max_length, n_packets, bits_for_length, width, prob_
         packets.append(packet)
     return data, packets
 
-def stream_to_packets(stream, bits_for_length=msg_length_width, width=msg_width, allow_samples=True):
-    header_shift = pow(2, width-1)
-    length_shift1 = pow(2, width-1-bits_for_length)
-    length_shift2 = pow(2, bits_for_length)
-    in_packet = False
-    packet_length = None
-    packet_pos = None
-    packet = None
-    packets = []
-    for block in stream:
-        if block is None:
-            continue
-        header = block // header_shift
-        if header:
-            packet_length = block // length_shift1 - header*length_shift2
-            if in_packet:
-                raise ValueError("Got a header when we weren't expecting it. Pos is {0}. New length is {1}".format(packet_pos, packet_length))
-            if packet_length > 0:
-                packet_pos = 0
-                in_packet = True
-                packet = [block]
+class StreamParser(object):
+    """
+    Incrementally splits a stream of blocks into packets.
+
+    Blocks can be fed in as chunks as they arrive.  A partially received
+    packet is kept between chunks so the whole stream never needs to be
+    held in memory.  A block that is not part of a packet is a sample and
+    is treated as a packet of length 1.
+
+    Args:
+        bits_for_length: Number of header bits that give the packet length.
+        width: Bit width of a block.
+        allow_samples: Whether blocks outside of packets are allowed.
+    """
+
+    def __init__(self, bits_for_length=msg_length_width, width=msg_width,
+                 allow_samples=True):
+        self.header_shift = pow(2, width-1)
+        self.length_shift1 = pow(2, width-1-bits_for_length)
+        self.length_shift2 = pow(2, bits_for_length)
+        self.allow_samples = allow_samples
+        self.packet = None
+        self.packet_length = None
+        self.packet_pos = None
+
+    def feed(self, blocks):
+        """
+        Generator yielding the packets that are completed by `blocks`.
+        """
+        for block in blocks:
+            if block is None:
+                continue
+            header = block // self.header_shift
+            if header:
+                packet_length = block // self.length_shift1 - header*self.length_shift2
+                if self.packet is not None:
+                    raise ValueError("Got a header when we weren't expecting it. Pos is {0}. New length is {1}".format(self.packet_pos, packet_length))
+                if packet_length > 0:
+                    self.packet_pos = 0
+                    self.packet_length = packet_length
+                    self.packet = [block]
+                else:
+                    yield [block]
+            elif self.packet is None:
+                # Treat a sample as a packet of length 1.
+                if not self.allow_samples:
+                    raise ValueError("No header found when expecting one.")
+                yield [block]
+            else:
+                self.packet.append(block)
+                self.packet_pos += 1
+                if self.packet_pos == self.packet_length:
+                    packet = self.packet
+                    self.packet = None
+                    self.packet_length = None
+                    self.packet_pos = None
+                    yield packet
+
+    def feed_samples_and_packets(self, blocks):
+        """
+        Generator yielding (sample, packet) pairs for `blocks`.
+        One of the two is always None.
+        """
+        for p in self.feed(blocks):
+            if len(p) == 1 and not (p[0] // self.header_shift):
+                yield p[0], None
             else:
-                packets.append([block])
-        if (not header) and (not in_packet):
-            # Treat a sample as a packet of length 1.
-            if not allow_samples:
-                raise ValueError("No header found when expecting one.")
-            packets.append([block])
-        if (not header) and in_packet:
-            packet.append(block)
-            packet_pos += 1
-            if packet_pos == packet_length:
-                packets.append(packet)
-                packet = None
-                in_packet = False
-                packet_pos = None
-    if packet is not None:
-        print(packet)
-        raise ValueError("Incomplete packets")
+                yield None, p
+
+    def close(self):
+        """
+        Check that the stream did not end part way through a packet.
+        """
+        if self.packet is not None:
+            raise ValueError("Incomplete packets: {0}".format(self.packet))
+
+def iter_samples_and_packets(chunks, bits_for_length=msg_length_width,
+                             width=msg_width):
+    """
+    Generator that parses an iterable of chunks of blocks.
+    Yields a (samples, packets) pair for every chunk.
+    """
+    parser = StreamParser(bits_for_length, width, True)
+    for chunk in chunks:
+        samples = []
+        packets = []
+        for s, p in parser.feed_samples_and_packets(chunk):
+            if p is None:
+                samples.append(s)
+            else:
+                packets.append(p)
+        yield samples, packets
+    parser.close()
+
+def stream_to_packets(stream, bits_for_length=msg_length_width, width=msg_width, allow_samples=True):
+    parser = StreamParser(bits_for_length, width, allow_samples)
+    packets = list(parser.feed(stream))
+    parser.close()
     return packets
 
 def stream_to_samples_and_packets(stream, bits_for_length=msg_length_width, width=msg_width):
-    header_shift = pow(2, width-1)
-    mixed = stream_to_packets(stream, bits_for_length, width, True)
-    packets = []
     samples = []
-    for p in mixed:
-        if len(p) > 1:
-            packets.append(p)
-        else:
-            header = p[0] // header_shift
-            if header:
-                packets.append(p)
-            else:
-                samples.append(p[0])
+    packets = []
+    for s, p in iter_samples_and_packets([stream], bits_for_length, width):
+        samples.extend(s)
+        packets.extend(p)
+    return samples, packets
+
+def demux_stream(stream, bits_for_length=msg_length_width, width=msg_width):
+    """
+    Splits a stream of blocks into samples and packets using array
+    operations rather than a python loop.
+
+    Returns:
+        A tuple (samples, offsets, lengths) where samples is an array of the
+        blocks that are not part of a packet, offsets are the positions of
+        the packet headers in the stream and lengths are the number of blocks
+        following each header.
+        Returns None if the stream contains malformed packets (a packet that
+        overlaps the next header or runs off the end of the stream).
+    """
+    stream = numpy.asarray(stream, dtype=numpy.uint64)
+    n_blocks = len(stream)
+    is_header = (stream >> numpy.uint64(width-1)) != 0
+    offsets = numpy.flatnonzero(is_header)
+    length_mask = numpy.uint64(pow(2, bits_for_length)-1)
+    lengths = ((stream[offsets] >> numpy.uint64(width-1-bits_for_length))
+               & length_mask).astype(numpy.int64)
+    ends = offsets + lengths
+    next_offsets = numpy.append(offsets[1:], n_blocks)
+    if numpy.any(ends >= next_offsets):
+        return None
+    samples = stream[~packet_mask(n_blocks, offsets, lengths)]
+    return samples, offsets, lengths
+
+def packet_mask(n_blocks, offsets, lengths):
+    """
+    Which blocks of a stream belong to packets.
+
+    Args:
+        n_blocks: The length of the stream.
+        offsets: The positions of the packet headers (as from demux_stream).
+        lengths: The number of blocks following each header.
+
+    Returns:
+        A boolean array that is True for headers and packet contents.
+    """
+    offsets = numpy.asarray(offsets, dtype=numpy.int64)
+    ends = offsets + numpy.asarray(lengths, dtype=numpy.int64)
+    marks = numpy.zeros(n_blocks+1, dtype=numpy.int64)
+    marks[offsets] += 1
+    marks[ends+1] -= 1
+    return numpy.cumsum(marks[:n_blocks]) > 0
+
+def fast_stream_to_samples_and_packets(stream, bits_for_length=msg_length_width,
+                                       width=msg_width):
+    """
+    Same as stream_to_samples_and_packets except that the samples are
+    returned as a uint64 array and the stream is split with demux_stream.
+
+    Falls back to stream_to_samples_and_packets if the stream cannot be
+    split by demux_stream (so that malformed packets are reported in the
+    same way).
+    """
+    try:
+        demuxed = demux_stream(stream, bits_for_length, width)
+    except TypeError:
+        # The stream contains None values.
+        demuxed = None
+    if demuxed is None:
+        samples, packets = stream_to_samples_and_packets(
+            stream, bits_for_length, width)
+        return numpy.array(samples, dtype=numpy.uint64), packets
+    samples, offsets, lengths = demuxed
+    stream = numpy.asarray(stream, dtype=numpy.uint64)
+    packets = [stream[o: o+l+1].tolist()
+               for o, l in zip(offsets.tolist(), lengths.tolist())]
     return samples, packets
-            
+
+class FastStreamParser(object):
+    """
+    Same as StreamParser except that each chunk is split with
+    demux_stream.
+
+    A packet that runs off the end of a chunk is kept and put in front of
+    the next chunk.
+
+    Args:
+        bits_for_length: Number of header bits that give the packet length.
+        width: Bit width of a block.
+    """
+
+    def __init__(self, bits_for_length=msg_length_width, width=msg_width):
+        self.bits_for_length = bits_for_length
+        self.width = width
+        self.carry = numpy.zeros(0, dtype=numpy.uint64)
+
+    def feed(self, blocks):
+        """
+        Split a chunk of blocks.
+
+        Returns:
+            A tuple (samples, packets) where samples is a uint64 array of
+            the blocks not in packets and packets is a list of the
+            packets completed by this chunk.
+        """
+        stream = numpy.concatenate(
+            (self.carry, numpy.asarray(blocks, dtype=numpy.uint64)))
+        is_header = (stream >> numpy.uint64(self.width-1)) != 0
+        offsets = numpy.flatnonzero(is_header)
+        self.carry = stream[:0]
+        if len(offsets):
+            last = offsets[-1]
+            length_mask = numpy.uint64(pow(2, self.bits_for_length)-1)
+            last_length = int((stream[last] >> numpy.uint64(
+                        self.width-1-self.bits_for_length)) & length_mask)
+            if last + last_length >= len(stream):
+                self.carry = stream[last:]
+                stream = stream[:last]
+        return fast_stream_to_samples_and_packets(
+            stream, self.bits_for_length, self.width)
+
+    def close(self):
+        """
+        Check that the stream did not end part way through a packet.
+        """
+        if len(self.carry):
+            raise ValueError("Incomplete packets: {0}".format(self.carry.tolist()))
 
 def make_packet_dict(packets):
     packet_dict = {}
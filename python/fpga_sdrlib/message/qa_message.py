@@ -9,8 +9,8 @@ import shutil
 
 from fpga_sdrlib.generate import logceil
 from fpga_sdrlib import config, b100, buildutils
-from fpga_sdrlib.message import msg_utils
-from fpga_sdrlib.testbench import TestBenchB100, TestBenchIcarusOuter
+from fpga_sdrlib.message import msg_utils, combiner
+from fpga_sdrlib.testbench import TestBenchB100, TestBenchIcarusOuter, TestBenchIcarusFile
 from fpga_sdrlib.uhd.qa_uhd import bits_to_int
 
 from myhdl import Cosimulation, Signal, delay, always, Simulation
@@ -86,13 +86,19 @@ class TestMessageStreamCombiner(unittest.TestCase):
              })
         executable = buildutils.generate_icarus_executable(
             'message', 'message_stream_combiner', '-one_stream', defines)
+        file_executable = buildutils.generate_icarus_executable(
+            'message', 'message_stream_combiner', '-one_stream', defines,
+            file_driven=True)
         tb = TestBenchIcarusOuter(executable, in_raw=data, width=width,
                                   output_msgs=False)
-        tb.run(steps_rqd)
-        # Confirm that our data is correct.
-        self.assertEqual(len(tb.out_raw), len(data))
-        for r, e in zip(tb.out_raw, data):
-            self.assertEqual(e, r)
+        tb_file = TestBenchIcarusFile(file_executable, in_raw=data, width=width,
+                                      output_msgs=False)
+        for tb in (tb, tb_file):
+            tb.run(steps_rqd, expected_outputs=len(data))
+            # Confirm that our data is correct.
+            self.assertEqual(len(tb.out_raw), len(data))
+            for r, e in zip(tb.out_raw, data):
+                self.assertEqual(e, r)
 
     def test_streams(self):
         """
@@ -155,6 +161,143 @@ class TestMessageStreamCombiner(unittest.TestCase):
             tb.out_raw, config.msg_length_width, width, allow_samples=False)
         received_packet_dict = msg_utils.make_packet_dict(received_packets)
         self.assertEqual(expected_packet_dict, received_packet_dict)
+        # The model gives the words in the same order as the verilog.
+        model_datas, error = combiner.combine_streams(
+            data_streams, tb.sendnth, width, buffer_length,
+            config.msg_length_width)
+        self.assertFalse(error)
+        self.assertEqual(model_datas.tolist(), tb.out_raw)
+
+class TestMessageStreamCombinerModel(unittest.TestCase):
+
+    def setUp(self):
+        self.rg = random.Random(0)
+
+    def test_streams(self):
+        """
+        Test the model of the stream combiner with a large number of packets.
+        """
+        width = 32
+        sendnth = 8
+        n_streams = 3
+        buffer_length = 128
+        top_packet_length = 16
+        n_packets = 1000
+        prob_start = 0.1
+        data_streams = []
+        packet_stream = []
+        for i in range(n_streams):
+            data, packets = msg_utils.generate_random_packets(
+                top_packet_length, n_packets, config.msg_length_width,
+                width, prob_start, self.rg)
+            data_streams.append(data)
+            packet_stream += packets
+        expected_packet_dict = msg_utils.make_packet_dict(packet_stream)
+        out_datas, error = combiner.combine_streams(
+            data_streams, sendnth, width, buffer_length, config.msg_length_width)
+        self.assertFalse(error)
+        received_packets = msg_utils.stream_to_packets(
+            out_datas.tolist(), config.msg_length_width, width,
+            allow_samples=False)
+        received_packet_dict = msg_utils.make_packet_dict(received_packets)
+        self.assertEqual(expected_packet_dict, received_packet_dict)
+
+    def test_overflow(self):
+        """
+        Input that arrives faster than it can be output overflows the buffers.
+        """
+        width = 32
+        data, packets = msg_utils.generate_random_packets(
+            16, 100, config.msg_length_width, width, 1, self.rg)
+        out_datas, error = combiner.combine_streams(
+            [data, data], 0, width, 4, config.msg_length_width)
+        self.assertTrue(error)
+
+class TestStreamParser(unittest.TestCase):
+
+    def setUp(self):
+        self.rg = random.Random(0)
+
+    def test_chunks(self):
+        """
+        Test that parsing a stream in chunks matches parsing it whole.
+        """
+        width = 32
+        data, packets = msg_utils.generate_random_packets(
+            16, 20, config.msg_length_width, width, 0.3, self.rg,
+            none_sample=False)
+        e_samples, e_packets = msg_utils.stream_to_samples_and_packets(
+            data, config.msg_length_width, width)
+        chunks = []
+        pos = 0
+        while pos < len(data):
+            chunk_length = self.rg.randint(1, 7)
+            chunks.append(data[pos: pos+chunk_length])
+            pos += chunk_length
+        r_samples = []
+        r_packets = []
+        for samples, packets in msg_utils.iter_samples_and_packets(
+                chunks, config.msg_length_width, width):
+            r_samples.extend(samples)
+            r_packets.extend(packets)
+        self.assertEqual(e_samples, r_samples)
+        self.assertEqual(e_packets, r_packets)
+
+    def test_demux(self):
+        """
+        Test that the array based demultiplexer matches the parser.
+        """
+        width = 32
+        data, packets = msg_utils.generate_random_packets(
+            16, 20, config.msg_length_width, width, 0.3, self.rg,
+            none_sample=False)
+        e_samples, e_packets = msg_utils.stream_to_samples_and_packets(
+            data, config.msg_length_width, width)
+        r_samples, r_packets = msg_utils.fast_stream_to_samples_and_packets(
+            data, config.msg_length_width, width)
+        self.assertEqual(e_samples, r_samples.tolist())
+        self.assertEqual(e_packets, r_packets)
+        # A truncated packet is reported by the scalar parser.
+        header = msg_utils.generate_header(4, config.msg_length_width, width)
+        self.assertRaises(ValueError, msg_utils.fast_stream_to_samples_and_packets,
+                          data + [header, 0], config.msg_length_width, width)
+
+    def test_incomplete(self):
+        """
+        Test that a stream ending part way through a packet is an error.
+        """
+        width = 32
+        packet = msg_utils.generate_random_packet(4, config.msg_length_width, width)
+        parser = msg_utils.StreamParser(config.msg_length_width, width)
+        self.assertEqual(list(parser.feed(packet[:3])), [])
+        self.assertRaises(ValueError, parser.close)
+        self.assertEqual(list(parser.feed(packet[3:])), [packet])
+        parser.close()
+
+    def test_count_samples(self):
+        """
+        TestBenchIcarusOuter only counts samples towards expected_outputs.
+        """
+        data, packets = msg_utils.generate_random_packets(
+            16, 20, config.msg_length_width, config.msg_width, 0.3, self.rg,
+            none_sample=False)
+        samples, offsets, lengths = msg_utils.demux_stream(
+            data, config.msg_length_width, config.msg_width)
+        is_sample = ~msg_utils.packet_mask(len(data), offsets, lengths)
+        tb = TestBenchIcarusOuter('unused', in_raw=[])
+        tb.get_output()
+        pos = 0
+        while pos < len(data):
+            # The blocks arrive a few at a time.
+            pos = min(pos + self.rg.randint(1, 7), len(data))
+            tb.out_raw = data[:pos]
+            self.assertEqual(tb.n_outputs(), int(is_sample[:pos].sum()))
+        self.assertEqual(tb.n_outputs(), len(samples))
+        # Without messages every block is counted.
+        tb = TestBenchIcarusOuter('unused', in_raw=[], output_msgs=False)
+        tb.get_output()
+        tb.out_raw = data
+        self.assertEqual(tb.n_outputs(), len(data))
 
 class TestMessageSlicer(unittest.TestCase):
 
@@ -0,0 +1,208 @@
+# Copyright (c) 2012 Ben Reynwar
+# Released under MIT License (see LICENSE.txt)
+
+"""
+Find the smallest sendnth that a module can handle.
+
+For each configuration (block name, defines, extraargs and input) the
+sendnth is bisected, checking that the output still matches the
+expected output and that the error wire stays low.  All the
+configurations are bisected together so that the simulations in each
+round run in parallel (see testbench.run_testbenches).
+"""
+
+import json
+import logging
+
+from fpga_sdrlib import config, buildutils
+from fpga_sdrlib.testbench import TestBenchIcarusInner, TestBenchIcarusOuter
+from fpga_sdrlib.testbench import run_testbenches
+
+logger = logging.getLogger(__name__)
+
+class Configuration(object):
+    """
+    A module and the input to test it with.
+
+    Args:
+        package: The package containing the block.
+        name: The block name (as in the package's blocks).
+        in_samples: The input samples.
+        expected: The expected output samples (from the golden model).
+        start_msgs: Messages to send before the samples.
+        defines: Macro definitions for the verilog.
+        extraargs: Arguments for the templates.
+        inner: Use TestBenchIcarusInner rather than TestBenchIcarusOuter.
+        tol: How close the output must be to the expected output.
+    """
+
+    def __init__(self, package, name, in_samples, expected, start_msgs=None,
+                 defines=config.default_defines, extraargs=None, inner=False,
+                 tol=1e-3):
+        if extraargs is None:
+            extraargs = {}
+        self.package = package
+        self.name = name
+        self.in_samples = in_samples
+        self.expected = expected
+        self.start_msgs = start_msgs
+        self.defines = defines
+        self.extraargs = extraargs
+        self.inner = inner
+        self.tol = tol
+        self.executable = None
+
+    def make_testbench(self, sendnth):
+        if self.inner:
+            return TestBenchIcarusInner(
+                self.executable, self.in_samples, start_msgs=self.start_msgs,
+                sendnth=sendnth, width=self.defines['WIDTH'])
+        else:
+            return TestBenchIcarusOuter(
+                self.executable, self.in_samples, start_msgs=self.start_msgs,
+                sendnth=sendnth, width=self.defines['WIDTH'])
+
+    def clks(self, sendnth):
+        n_in = len(self.in_samples)
+        if self.start_msgs is not None:
+            n_in += len(self.start_msgs)
+        return n_in*(sendnth+1)*2 + 1000
+
+    def check(self, tb):
+        """
+        Whether the output of a testbench run is correct.
+        """
+        if len(tb.out_samples) != len(self.expected):
+            return False
+        for r, e in zip(tb.out_samples, self.expected):
+            if abs(r-e) > self.tol:
+                return False
+        return True
+
+class SweepResult(object):
+    """
+    The result of a sweep for one configuration.
+
+    Attributes:
+        min_sendnth: The smallest sendnth that worked (None if even
+            max_sendnth failed).
+        samples_per_clock: The maximum sustainable input rate.
+        log_sendnth: The smallest LOG_SENDNTH that could be used on
+            the B100 (which sends every 2**LOG_SENDNTH cycles).
+        timing: The TimingReport of the run at min_sendnth.
+    """
+
+    def __init__(self, configuration, min_sendnth, timing=None):
+        self.configuration = configuration
+        self.min_sendnth = min_sendnth
+        self.timing = timing
+        if min_sendnth is None:
+            self.samples_per_clock = None
+            self.log_sendnth = None
+        else:
+            self.samples_per_clock = 1.0/(min_sendnth+1)
+            self.log_sendnth = 0
+            while pow(2, self.log_sendnth) < min_sendnth+1:
+                self.log_sendnth += 1
+
+    def to_dict(self):
+        d = {
+            'package': self.configuration.package,
+            'name': self.configuration.name,
+            'extraargs': self.configuration.extraargs,
+            'min_sendnth': self.min_sendnth,
+            'samples_per_clock': self.samples_per_clock,
+            'log_sendnth': self.log_sendnth,
+            }
+        if self.timing is not None:
+            d['timing'] = self.timing.to_dict()
+        return d
+
+def run_round(configurations, sendnths, processes=None):
+    """
+    Run each configuration once at the given sendnth.
+
+    A run that raises an error (e.g. the error wire going high) counts
+    as a failure since the sendnth was too small.
+
+    Returns:
+        A list of (passed, testbench) tuples.
+    """
+    jobs = []
+    for c, s in zip(configurations, sendnths):
+        jobs.append((c.make_testbench(s), c.clks(s),
+                     {'expected_outputs': len(c.expected),
+                      'idle_timeout': 1000,
+                      'instrument': True}))
+    tbs = run_testbenches(jobs, processes, raise_errors=False)
+    results = []
+    for c, tb in zip(configurations, tbs):
+        if tb.run_error is not None:
+            logger.debug("{0} failed: {1}".format(tb.executable, tb.run_error))
+            results.append((False, tb))
+        else:
+            results.append((c.check(tb), tb))
+    return results
+
+def sweep(configurations, max_sendnth=16, processes=None, suffix='-sweep'):
+    """
+    Bisect the sendnth of each configuration.
+
+    The run at max_sendnth is done first; configurations that fail it
+    get a min_sendnth of None.  Otherwise it is assumed that every
+    sendnth above the smallest working one also works.
+
+    Args:
+        configurations: A list of Configurations.
+        max_sendnth: The largest sendnth to try.
+        processes: The number of simulations to run at once.
+        suffix: The suffix for the executables.
+
+    Returns:
+        A list of SweepResults.
+    """
+    requests = [(c.package, c.name, '{0}{1}'.format(suffix, i),
+                 c.defines, c.extraargs)
+                for i, c in enumerate(configurations)]
+    builds = buildutils.generate_icarus_executables(requests, processes)
+    for c, b in zip(configurations, builds):
+        c.executable = b.get()
+    # The smallest sendnth known to fail and the largest known to pass.
+    lows = [-1]*len(configurations)
+    highs = [max_sendnth]*len(configurations)
+    timings = [None]*len(configurations)
+    passed = run_round(configurations, highs, processes)
+    for i, (p, tb) in enumerate(passed):
+        if p:
+            timings[i] = tb.timing
+        else:
+            highs[i] = None
+    while True:
+        active = [i for i in range(len(configurations))
+                  if highs[i] is not None and highs[i] - lows[i] > 1]
+        if not active:
+            break
+        mids = [(lows[i] + highs[i])//2 for i in active]
+        results = run_round([configurations[i] for i in active], mids,
+                            processes)
+        for i, mid, (p, tb) in zip(active, mids, results):
+            if p:
+                highs[i] = mid
+                timings[i] = tb.timing
+            else:
+                lows[i] = mid
+    results = []
+    for c, high, timing in zip(configurations, highs, timings):
+        result = SweepResult(c, high, timing)
+        logger.info("{0}.{1} {2}: min sendnth {3}".format(
+                c.package, c.name, c.extraargs, high))
+        results.append(result)
+    return results
+
+def write_results(results, fn):
+    """
+    Write a list of SweepResults to a JSON file.
+    """
+    f = open(fn, 'w')
+    json.dump([r.to_dict() for r in results], f, indent=2, sort_keys=True)
+    f.close()
@@ -1,42 +1,87 @@
 # Copyright (c) 2012 Ben Reynwar
 # Released under MIT License (see LICENSE.txt)
 
+import multiprocessing
 import os
+import shutil
+import subprocess
+import tempfile
 
-from myhdl import Cosimulation, Signal, delay, always, Simulation, _simulator
+import numpy
+from myhdl import Cosimulation, Signal, delay, always, Simulation, _simulator, StopSimulation
 
 from gnuradio import uhd, gr
 
 from fpga_sdrlib import config
 from fpga_sdrlib import b100
-from fpga_sdrlib.conversions import c_to_int, int_to_c
+from fpga_sdrlib.conversions import c_to_int_array, int_to_c_array
 from fpga_sdrlib.message.msg_utils import stream_to_samples_and_packets
+from fpga_sdrlib.message.msg_utils import fast_stream_to_samples_and_packets
+from fpga_sdrlib.message.msg_utils import demux_stream, packet_mask
+from fpga_sdrlib.message.msg_utils import FastStreamParser
+from fpga_sdrlib.timing import TimingReport
+from fpga_sdrlib.flow import read_buffer_stats
 
 def flip_bits(seq, width):
     """
     Takes a sequence of integers.  For each integer the higher and lower
     bits are swapped round.  Necessary to work around a bug in
     gr-uhd.
+
+    Returns an unsigned integer array.  For 32 bit words the swap is done
+    by viewing each word as a pair of 16 bit halves.
+    """
+    if width == 32:
+        words = numpy.ascontiguousarray(seq, dtype=numpy.uint32)
+        halves = words.reshape(-1).view(numpy.uint16).reshape(-1, 2)
+        return halves[:, ::-1].copy().view(numpy.uint32).reshape(words.shape)
+    words = numpy.asarray(seq, dtype=numpy.uint64)
+    h = numpy.uint64(width//2)
+    low_mask = numpy.uint64(pow(2, width//2)-1)
+    return (words >> h) | ((words & low_mask) << h)
+
+def nonzero_bounds(words, chunk_size):
+    """
+    Find the first and last non-zero words of a (possibly memory mapped)
+    array, looking at one chunk at a time from each end.
+
+    Returns:
+        (first, last) or (None, None) if all the words are zero.
     """
-    out = []
-    h = pow(2, width//2)
-    for x in seq:
-        high_bits = x//h
-        low_bits = x % h
-        out.append(high_bits + low_bits * h)
-    return out
+    n = len(words)
+    first = None
+    for start in range(0, n, chunk_size):
+        nonzero = numpy.flatnonzero(words[start: start+chunk_size])
+        if len(nonzero):
+            first = start + nonzero[0]
+            break
+    if first is None:
+        return None, None
+    for stop in range(n, first, -chunk_size):
+        start = max(stop-chunk_size, first)
+        nonzero = numpy.flatnonzero(words[start: stop])
+        if len(nonzero):
+            return int(first), int(start + nonzero[-1])
 
 def unsigned_to_signed(seq, width):
     """
     Convert unsigned integer to signed.
     """
-    out = []
-    k = pow(2, width)
-    for x in seq:
-        if x >= k/2:
-            x -= k
-        out.append(x)
-    return out
+    if width == 32:
+        return numpy.asarray(seq, dtype=numpy.uint32).view(numpy.int32)
+    xs = numpy.asarray(seq, dtype=numpy.uint64).astype(numpy.int64)
+    xs[xs >= pow(2, width-1)] -= pow(2, width)
+    return xs
+
+def signed_to_unsigned(seq, width):
+    """
+    Convert signed integer to unsigned.
+    """
+    if width == 32:
+        return numpy.asarray(seq, dtype=numpy.int32).view(numpy.uint32)
+    xs = numpy.array(seq, dtype=numpy.int64)
+    xs[xs < 0] += pow(2, width)
+    return xs.astype(numpy.uint64)
         
 def compare_unaligned(xs, ys, tol):
     """
@@ -51,23 +96,57 @@ def compare_unaligned(xs, ys, tol):
        The maximum number of continuous matching elements starting from the
        beginning.
     """
-    matched = False
-    max_streak = 0
-    N = len(xs)
-    for offset in range(len(ys)-len(xs)):
-        worked = True
-        streak = N
-        for i in range(N):
-            if abs(xs[i] - ys[offset+i]) > tol:
-                worked = False
-                streak = i
-                break
-        max_streak = max(streak, max_streak)
-        if worked:
-            matched = True
-            break
+    max_streak, offset = align_unaligned(xs, ys, tol)
     return max_streak
 
+def align_unaligned(xs, ys, tol, n_candidates=8):
+    """
+    Find the alignment of a sequence within a longer sequence.
+
+    Candidate offsets are found by cross-correlating the sequences with
+    numpy.fft.  If none of the candidates match completely, every offset
+    is checked, discarding offsets as soon as they stop matching.
+
+    Args:
+       xs: the shorter sequence
+       ys: the longer sequence (should contain xs somewhere within)
+       tol: how close individual elements must be
+       n_candidates: how many of the best correlated offsets to check first
+
+    Returns:
+       (max_streak, offset) where max_streak is the same as returned by
+       compare_unaligned and offset is the offset of ys at which it
+       occurs (None if ys is not longer than xs).
+    """
+    xs = numpy.asarray(xs, dtype=complex)
+    ys = numpy.asarray(ys, dtype=complex)
+    N = len(xs)
+    n_offsets = len(ys) - N
+    if n_offsets <= 0:
+        return 0, None
+    if N == 0:
+        return 0, 0
+    # Squared error between xs and ys at each offset.
+    L = pow(2, int(numpy.ceil(numpy.log2(len(ys)))))
+    corr = numpy.fft.ifft(numpy.fft.fft(ys, L) * numpy.conj(numpy.fft.fft(xs, L)))
+    cumulative = numpy.concatenate(([0], numpy.cumsum(numpy.abs(ys)**2)))
+    ys_power = cumulative[N: N+n_offsets] - cumulative[:n_offsets]
+    errors = (numpy.sum(numpy.abs(xs)**2) + ys_power
+              - 2*corr[:n_offsets].real)
+    n_candidates = min(n_candidates, n_offsets)
+    candidates = numpy.argpartition(errors, n_candidates-1)[:n_candidates]
+    for offset in candidates[numpy.argsort(errors[candidates])]:
+        if not numpy.any(numpy.abs(xs - ys[offset: offset+N]) > tol):
+            return N, int(offset)
+    # No candidate matched so check them all.
+    alive = numpy.arange(n_offsets)
+    for i in range(N):
+        matching = alive[~(numpy.abs(xs[i] - ys[alive+i]) > tol)]
+        if len(matching) == 0:
+            return i, int(alive[0])
+        alive = matching
+    return N, int(alive[0])
+
 """
 What testbenchs do I need:
   samples, msgs, ms (raw module)
@@ -98,19 +177,121 @@ class TestBenchIcarusBase(object):
             self.clk.next = not self.clk
         return run
 
-    def run(self, clks):
+    def run(self, clks, expected_outputs=None, idle_timeout=None,
+            instrument=False, report_fn=None, buffer_stats=False):
         """
         Run a test bench simulation.
+
+        Args:
+            clks: The maximum number of clock cycles to simulate.
+            expected_outputs: Stop once this many outputs are received.
+                For TestBenchIcarusOuter only samples are counted, not
+                message blocks.
+            idle_timeout: Stop once all the input is sent and there has
+                been no output for this many clock cycles.
+            instrument: Record the cycles at which samples go in and come
+                out and put a TimingReport in timing.
+            report_fn: Write the TimingReport to this file as JSON
+                (implies instrument).
+            buffer_stats: Collect the occupancy statistics of the buffers
+                in buffer_stats (see flow.read_buffer_stats).  The
+                executable must be built with DEBUG defined.
+
+        The number of clock cycles simulated is stored in cycles_used.
         """
+        self.expected_outputs = expected_outputs
+        self.idle_timeout = idle_timeout
         myhdlvpi = os.path.join(config.verilogdir, 'myhdl.vpi')
         command = "vvp -m {myhdlvpi} {executable}".format(myhdlvpi=myhdlvpi, executable=self.executable)
+        if buffer_stats:
+            stats_fn = self.make_stats_file()
+            command += " +buffer_stats={0}".format(stats_fn)
         cosimdict = dict([(sn, getattr(self, sn)) for sn in self.signal_names])
         dut = Cosimulation(command, **cosimdict)
         drivers = [df() for df in self.drivers]
+        drivers.append(self.stop_early())
+        instrument = instrument or report_fn is not None
+        if instrument:
+            drivers.append(self.record_timing())
         sim = Simulation(dut, *drivers)
         sim.run(2*clks)
         dut.__del__()
         del dut
+        if buffer_stats:
+            self.collect_buffer_stats(stats_fn)
+        if instrument:
+            self.make_timing_report(report_fn)
+
+    def make_stats_file(self):
+        # The buffers append to the file.
+        fd, stats_fn = tempfile.mkstemp(prefix='buffer_stats_')
+        os.close(fd)
+        return stats_fn
+
+    def collect_buffer_stats(self, stats_fn):
+        try:
+            self.buffer_stats = read_buffer_stats(stats_fn)
+        finally:
+            os.remove(stats_fn)
+
+    def record_timing(self):
+        self.in_cycles = []
+        self.out_cycles = []
+        self.timing_cycle = 0
+        @always(self.clk.posedge)
+        def run():
+            """
+            Records the cycles at which data goes in and out.
+            """
+            self.timing_cycle += 1
+            if self.in_nd:
+                self.in_cycles.append(self.timing_cycle)
+            if self.out_nd:
+                self.out_cycles.append(self.timing_cycle)
+        return run
+
+    def sample_cycles(self):
+        """
+        The cycles at which samples (rather than messages) went in and
+        came out.
+        """
+        return self.in_cycles, self.out_cycles
+
+    def make_timing_report(self, report_fn=None):
+        in_cycles, out_cycles = self.sample_cycles()
+        self.timing = TimingReport(in_cycles, out_cycles, self.sendnth,
+                                   n_cycles=self.cycles_used,
+                                   name=os.path.basename(self.executable))
+        if report_fn is not None:
+            self.timing.write(report_fn)
+
+    def stop_early(self):
+        self.cycles_used = 0
+        self.last_active_cycle = 0
+        @always(self.clk.posedge)
+        def run():
+            """
+            Stops the simulation once the expected outputs have arrived or
+            the design has been idle for idle_timeout cycles.
+            """
+            self.cycles_used += 1
+            if (self.out_nd or self.doing_prerun or
+                self.datapos < len(self.in_raw)):
+                self.last_active_cycle = self.cycles_used
+            if (self.expected_outputs is not None and
+                self.n_outputs() >= self.expected_outputs):
+                raise StopSimulation("Received the expected outputs.")
+            if (self.idle_timeout is not None and
+                self.cycles_used - self.last_active_cycle > self.idle_timeout):
+                raise StopSimulation("No output for {0} cycles.".format(self.idle_timeout))
+        return run
+
+    def n_outputs(self):
+        """
+        The number of outputs received so far (compared with
+        expected_outputs).
+        """
+        return len(self.out_raw)
 
     def get_output(self):
         self.out_raw = []
@@ -208,7 +389,7 @@ class TestBenchIcarusInner(TestBenchIcarusBase):
         self.drivers = [self.clk_driver, self.get_output, self.check_error,
                         self.send_input, self.prerun, self.get_message_stream]
         # ???
-        self.in_raw = [c_to_int(d, self.width/2) for d in self.in_samples]
+        self.in_raw = c_to_int_array(self.in_samples, self.width/2).tolist()
 
     def get_message_stream(self):
         @always(self.clk.posedge)
@@ -220,12 +401,14 @@ class TestBenchIcarusInner(TestBenchIcarusBase):
                 self.out_msgs.append(int(self.out_msg))
         return run
 
-    def run(self, clks):
+    def run(self, clks, expected_outputs=None, idle_timeout=None,
+            instrument=False, report_fn=None, buffer_stats=False):
         """
         Run a test bench simulation.
         """
-        TestBenchIcarusBase.run(self, clks)
-        self.out_samples = [int_to_c(r, self.width/2) for r in self.out_raw]
+        TestBenchIcarusBase.run(self, clks, expected_outputs, idle_timeout,
+                                instrument, report_fn, buffer_stats)
+        self.out_samples = int_to_c_array(self.out_raw, self.width/2).tolist()
         samples, packets = stream_to_samples_and_packets(self.out_msgs) 
         if samples:
             raise StandardError("Found samples is message stream.")
@@ -302,17 +485,71 @@ class TestBenchIcarusOuter(TestBenchIcarusBase):
             if self.start_msgs is not None:
                 self.in_raw += self.start_msgs
             # Subtracting 1 from width since we use 1st bit as a header.
-            self.in_raw += [c_to_int(d, self.width/2-1) for d in self.in_samples]
+            self.in_raw += c_to_int_array(self.in_samples, self.width/2-1).tolist()
+
+    def run(self, steps_rqd, expected_outputs=None, idle_timeout=None,
+            instrument=False, report_fn=None, buffer_stats=False):
+        super(TestBenchIcarusOuter, self).run(steps_rqd, expected_outputs,
+                                              idle_timeout, instrument,
+                                              report_fn, buffer_stats)
+        self.process_output()
+
+    def get_output(self):
+        self.n_parsed = 0
+        self.n_out_samples = 0
+        self.msg_blocks_left = 0
+        return super(TestBenchIcarusOuter, self).get_output()
+
+    def n_outputs(self):
+        """
+        The number of samples received so far.
 
-    def run(self, steps_rqd):
-        super(TestBenchIcarusOuter, self).run(steps_rqd)
+        The blocks received since the last call are parsed so that message
+        headers and the blocks following them are not counted.
+        """
+        if not self.output_msgs:
+            return len(self.out_raw)
+        header_shift = config.msg_width-1
+        length_shift = config.msg_width-1-config.msg_length_width
+        length_mask = pow(2, config.msg_length_width)-1
+        while self.n_parsed < len(self.out_raw):
+            block = self.out_raw[self.n_parsed]
+            self.n_parsed += 1
+            if self.msg_blocks_left:
+                self.msg_blocks_left -= 1
+            elif block >> header_shift:
+                self.msg_blocks_left = (block >> length_shift) & length_mask
+            else:
+                self.n_out_samples += 1
+        return self.n_out_samples
+
+    def sample_cycles(self):
+        """
+        Leaves out the start messages going in and the packets coming out.
+        """
+        n_msgs = 0
+        if self.start_msgs is not None:
+            n_msgs = len(self.start_msgs)
+        in_cycles = self.in_cycles[n_msgs:]
+        out_cycles = self.out_cycles
+        if self.output_msgs:
+            demuxed = demux_stream(self.out_raw)
+            if demuxed is not None:
+                samples, offsets, lengths = demuxed
+                is_sample = ~packet_mask(len(self.out_raw), offsets, lengths)
+                out_cycles = numpy.asarray(self.out_cycles)[is_sample].tolist()
+        return in_cycles, out_cycles
+
+    def process_output(self):
+        """
+        Split out_raw into out_samples and out_messages.
+        """
         header_shift = pow(2, self.width-1)
         if self.output_msgs:
-            samples, packets = stream_to_samples_and_packets(self.out_raw)
-            for s in samples:
-                if s == config.errorcode:
-                    raise ValueError("Errorcode detected.")
-            self.out_samples = [int_to_c(s, self.width/2-1) for s in samples]
+            samples, packets = fast_stream_to_samples_and_packets(self.out_raw)
+            if numpy.any(samples == config.errorcode):
+                raise ValueError("Errorcode detected.")
+            self.out_samples = int_to_c_array(samples, self.width/2-1).tolist()
             self.out_messages = packets
         #for p in packets:
         #    if p[0] // header_shift:
@@ -341,6 +578,206 @@ class TestBenchIcarusOuter(TestBenchIcarusBase):
         return run
 
 
+class TestBenchIcarusFile(TestBenchIcarusOuter):
+    """
+    The same as TestBenchIcarusOuter except that the simulation reads
+    its input from a file and writes its output to a file (see
+    uhd/file_qa_wrapper.v) so python is not involved in every clock
+    cycle.
+
+    The executable must be generated with file_driven=True.
+    """
+
+    def write_input(self, fn):
+        f = open(fn, 'w')
+        for d in self.in_raw:
+            if d is None:
+                f.write('0 0\n')
+            else:
+                f.write('1 {0:x}\n'.format(d))
+        f.close()
+
+    def read_output(self, fn):
+        f = open(fn, 'r')
+        words = f.read().split()
+        f.close()
+        try:
+            return [int(w, 16) for w in words]
+        except ValueError:
+            raise StandardError("Output contains undefined values.")
+
+    def read_timing(self, fn):
+        self.in_cycles = []
+        self.out_cycles = []
+        f = open(fn, 'r')
+        for line in f:
+            direction, cycle = line.split()
+            if direction == 'i':
+                self.in_cycles.append(int(cycle))
+            else:
+                self.out_cycles.append(int(cycle))
+        f.close()
+
+    def run(self, steps_rqd, expected_outputs=None, idle_timeout=None,
+            instrument=False, report_fn=None, buffer_stats=False):
+        instrument = instrument or report_fn is not None
+        filedir = tempfile.mkdtemp(prefix='file_qa_')
+        in_fn = os.path.join(filedir, 'in.txt')
+        out_fn = os.path.join(filedir, 'out.txt')
+        cycles_fn = os.path.join(filedir, 'cycles.txt')
+        timing_fn = os.path.join(filedir, 'timing.txt')
+        self.write_input(in_fn)
+        args = ['vvp', '-n', self.executable,
+                '+infile={0}'.format(in_fn),
+                '+outfile={0}'.format(out_fn),
+                '+cyclesfile={0}'.format(cycles_fn),
+                '+sendnth={0}'.format(self.sendnth),
+                '+clks={0}'.format(steps_rqd)]
+        if expected_outputs is not None:
+            args.append('+n_outputs={0}'.format(expected_outputs))
+            if self.output_msgs:
+                args.append('+count_samples')
+        if idle_timeout is not None:
+            args.append('+idle_timeout={0}'.format(idle_timeout))
+        if instrument:
+            args.append('+timingfile={0}'.format(timing_fn))
+        if buffer_stats:
+            stats_fn = self.make_stats_file()
+            args.append('+buffer_stats={0}'.format(stats_fn))
+        try:
+            if subprocess.call(args) != 0:
+                raise StandardError("Simulation of {0} failed.".format(self.executable))
+            self.out_raw = self.read_output(out_fn)
+            f = open(cycles_fn, 'r')
+            self.cycles_used = int(f.read())
+            f.close()
+            if instrument:
+                self.read_timing(timing_fn)
+        finally:
+            shutil.rmtree(filedir)
+        if buffer_stats:
+            self.collect_buffer_stats(stats_fn)
+        if instrument:
+            self.make_timing_report(report_fn)
+        self.process_output()
+
+class UHDTransport(object):
+    """
+    Sends words to and receives words from a B100 using gr-uhd.
+
+    Transports have three methods.  load_image loads an FPGA image, send
+    gives the words to send and receive sends them while receiving
+    n_receive words.  The words are signed with the high and low bits
+    flipped (see TestBenchB100).
+
+    Args:
+        device_addr: The UHD device address.
+        image_target: Where b100.set_image copies the image to.  If None
+            the image is loaded with the 'fpga' device argument instead.
+    """
+
+    def __init__(self, device_addr='', image_target=config.fpgaimage_fn):
+        self.device_addr = device_addr
+        self.image_target = image_target
+        self.image = None
+        self.words = None
+
+    def load_image(self, fpgaimage):
+        if self.image_target is not None:
+            b100.set_image(fpgaimage, self.image_target)
+        self.image = fpgaimage
+
+    def get_device_addr(self):
+        if self.image_target is None and self.image is not None:
+            args = [self.device_addr, 'fpga={0}'.format(self.image)]
+            return ','.join([a for a in args if a])
+        return self.device_addr
+
+    def send(self, words):
+        self.words = words
+
+    def receive(self, n_receive, capture_fn=None):
+        """
+        Send the words and receive n_receive words.
+
+        Args:
+            capture_fn: Write the received words to this file (as int32)
+                rather than returning them.
+        """
+        device_addr = self.get_device_addr()
+        stream_args = uhd.stream_args(cpu_format='sc16', channels=range(1))
+        from_usrp = uhd.usrp_source(device_addr=device_addr, stream_args=stream_args)
+        head = gr.head(4, n_receive)
+        if capture_fn is None:
+            snk = gr.vector_sink_i()
+        else:
+            snk = gr.file_sink(gr.sizeof_int, capture_fn)
+        to_usrp = uhd.usrp_sink(device_addr=device_addr, stream_args=stream_args)
+        src = gr.vector_source_i(numpy.asarray(self.words).tolist())
+        tb = gr.top_block()
+        tb.connect(from_usrp, head, snk)
+        tb.connect(src, to_usrp)
+        tb.run()
+        if capture_fn is None:
+            return snk.data()
+        snk.close()
+
+class LoopbackTransport(object):
+    """
+    Stands in for a B100 by running the words through an Icarus build of
+    the same qa_wrapper (with TestBenchIcarusFile).
+
+    The flipping of high and low bits done by gr-uhd is reproduced so the
+    whole of the TestBenchB100 code path is used.
+
+    Args:
+        executable: An executable built with file_driven=True.
+        sendnth: How often the qa_wrapper receives a word.
+        width: The width of a word.
+        lead_zeros: How many zeros to receive before the output (as the
+            B100 sends zeros when it has no data).
+        idle_timeout: Stop the simulation once there has been no output
+            for this many cycles.
+    """
+
+    def __init__(self, executable, sendnth=config.default_sendnth,
+                 width=config.default_width, lead_zeros=10, idle_timeout=1000):
+        self.executable = executable
+        self.sendnth = sendnth
+        self.width = width
+        self.lead_zeros = lead_zeros
+        self.idle_timeout = idle_timeout
+        self.image = None
+        self.words = None
+
+    def load_image(self, fpgaimage):
+        # The executable is used in place of the image.
+        self.image = fpgaimage
+
+    def send(self, words):
+        self.words = words
+
+    def receive(self, n_receive, capture_fn=None):
+        in_raw = flip_bits(signed_to_unsigned(self.words, self.width), self.width)
+        tb = TestBenchIcarusFile(self.executable, in_raw=in_raw.tolist(),
+                                 sendnth=self.sendnth, width=self.width,
+                                 output_msgs=False)
+        clks = (len(in_raw)+1)*(self.sendnth+1) + n_receive + self.idle_timeout
+        tb.run(clks, idle_timeout=self.idle_timeout)
+        self.cycles_used = tb.cycles_used
+        received = numpy.zeros(n_receive, dtype=numpy.int64)
+        out_raw = numpy.array(tb.out_raw[:max(n_receive-self.lead_zeros, 0)],
+                              dtype=numpy.uint64)
+        if len(out_raw):
+            out_raw = unsigned_to_signed(flip_bits(out_raw, self.width), self.width)
+            received[self.lead_zeros: self.lead_zeros+len(out_raw)] = out_raw
+        if capture_fn is None:
+            return received.tolist()
+        received.astype(numpy.int32).tofile(capture_fn)
+
+# The number of words processed at once by TestBenchB100 when streaming.
+default_chunk_size = pow(2, 20)
+
 class TestBenchB100(object):
     """
     A minimal TestBench to run the module on the B100 FPGA.
@@ -354,11 +791,17 @@ class TestBenchB100(object):
         width: Width of input data.
         in_raw: Raw integers to send instead of in_samples and start_msgs.
         output_msgs: Parse the output for messages.
+        transport: How words get to and from the FPGA (defaults to a
+                   UHDTransport).
     """
     
     def __init__(self, fpgaimage, in_samples=None, start_msgs=None, 
-                 width=config.default_width, in_raw=None, output_msgs=True):
+                 width=config.default_width, in_raw=None, output_msgs=True,
+                 transport=None):
         self.fpgaimage = fpgaimage
+        if transport is None:
+            transport = UHDTransport()
+        self.transport = transport
         self.in_samples = in_samples
         self.start_msgs = start_msgs
         self.width = width
@@ -371,65 +814,55 @@ class TestBenchB100(object):
             else:
                 self.in_raw = []
             # Subtracting 1 from width since we use 1st bit as a header.
-            self.in_raw += [c_to_int(d, self.width/2-1) for d in self.in_samples]
+            self.in_raw += c_to_int_array(self.in_samples, self.width/2-1).tolist()
         self.out_samples = []
         self.out_ms = []
         self.out_msgs = []
 
-    def run(self, n_receive=None):
+    def run(self, n_receive=None, streaming=False,
+            chunk_size=default_chunk_size, handle_chunk=None):
         """
         Run the simulation.
         
         Args:
             n_receive: Stop after receiving this many samples.
+            streaming: Write the received words to a file and process
+                them a chunk at a time so that long captures do not have
+                to fit in memory.
+            chunk_size: The number of words in a chunk when streaming.
+            handle_chunk: When streaming, call handle_chunk(out_raw,
+                out_samples, out_messages) for each chunk rather than
+                collecting the output in the testbench.
         """
-        b100.set_image(self.fpgaimage)
-        # steps_rqd only in for compatibility
-        from gnuradio import gr, uhd
         if n_receive is None:
             n_receive = 10000
         # Flip high and low bits of in_raw
         flipped_raw = flip_bits(self.in_raw, self.width)
         flipped_raw = unsigned_to_signed(flipped_raw, self.width)
-        stream_args = uhd.stream_args(cpu_format='sc16', channels=range(1))
-        from_usrp = uhd.usrp_source(device_addr='', stream_args=stream_args)
-        head = gr.head(4, n_receive)
-        snk = gr.vector_sink_i()
-        to_usrp = uhd.usrp_sink(device_addr='', stream_args=stream_args)
-        src = gr.vector_source_i(flipped_raw)
-        tb = gr.top_block()
-        tb.connect(from_usrp, head, snk)
-        tb.connect(src, to_usrp)
-        tb.run()
-        self.out_raw = snk.data()
+        if streaming:
+            fd, capture_fn = tempfile.mkstemp(prefix='b100_capture_')
+            os.close(fd)
+            try:
+                self.capture(flipped_raw, n_receive, capture_fn)
+                self.process_capture(capture_fn, chunk_size, handle_chunk)
+            finally:
+                os.remove(capture_fn)
+            return
+        out_raw = numpy.array(self.capture(flipped_raw, n_receive), dtype=numpy.int64)
         # Remove 0's
-        start_offset = None
-        stop_offset = None
-        enumerated_raw = list(enumerate(self.out_raw))
-        for i, r in enumerated_raw:
-            if r != 0:
-                start_offset = i
-                break
-        for i, r in reversed(enumerated_raw):
-            if r != 0:
-                stop_offset = i
-                break
-        if start_offset is None or stop_offset is None:
+        nonzero = numpy.flatnonzero(out_raw)
+        if len(nonzero) == 0:
             raise StandardError("Could not find any non-zero returned data.")
-        self.out_raw = self.out_raw[start_offset: stop_offset+1]
+        out_raw = out_raw[nonzero[0]: nonzero[-1]+1]
         # Shift to positive integers
-        positive = []
-        for r in self.out_raw:
-            if r < 0:
-                r += pow(2, self.width)
-            positive.append(r)
-        self.out_raw = positive
+        out_raw = signed_to_unsigned(out_raw, self.width)
         # Flip bits in out_raw
-        self.out_raw = flip_bits(self.out_raw, self.width)
+        out_raw = flip_bits(out_raw, self.width)
+        self.out_raw = out_raw.tolist()
         if self.output_msgs:
             header_shift = pow(2, self.width-1)
-            samples, packets = stream_to_samples_and_packets(self.out_raw)
-            self.out_samples = [int_to_c(s, self.width/2-1) for s in samples]
+            samples, packets = fast_stream_to_samples_and_packets(out_raw)
+            self.out_samples = int_to_c_array(samples, self.width/2-1).tolist()
             self.out_messages = packets
             #self.out_samples = []
             #self.out_messages = []
@@ -440,4 +873,148 @@ class TestBenchB100(object):
                     # It is a sample
             #        assert(len(p) == 1)
             #        self.out_samples.append(int_to_c(p[0], self.width/2-1))
-    
+
+    def capture(self, flipped_raw, n_receive, capture_fn=None):
+        """
+        Send data to the FPGA and receive n_receive words back.
+
+        Args:
+            flipped_raw: The signed words to send.
+            n_receive: The number of words to receive.
+            capture_fn: Write the received words to this file (as int32)
+                rather than returning them.
+        """
+        self.transport.load_image(self.fpgaimage)
+        self.transport.send(flipped_raw)
+        return self.transport.receive(n_receive, capture_fn)
+
+    def process_capture(self, capture_fn, chunk_size=default_chunk_size,
+                        handle_chunk=None):
+        """
+        Process a capture file written by capture a chunk at a time.
+
+        Only the words from the first to the last non-zero word are used.
+        """
+        if os.path.getsize(capture_fn) == 0:
+            raise StandardError("Could not find any non-zero returned data.")
+        words = numpy.memmap(capture_fn, dtype=numpy.int32, mode='r')
+        first, last = nonzero_bounds(words, chunk_size)
+        if first is None:
+            raise StandardError("Could not find any non-zero returned data.")
+        parser = FastStreamParser()
+        out_raws = []
+        out_samples = []
+        out_messages = []
+        for start in range(first, last+1, chunk_size):
+            chunk = words[start: min(start+chunk_size, last+1)]
+            chunk = flip_bits(signed_to_unsigned(chunk, self.width), self.width)
+            samples = None
+            packets = None
+            if self.output_msgs:
+                samples, packets = parser.feed(chunk)
+                samples = int_to_c_array(samples, self.width/2-1)
+            if handle_chunk is not None:
+                handle_chunk(chunk, samples, packets)
+            else:
+                out_raws.append(chunk.astype(numpy.uint64))
+                if self.output_msgs:
+                    out_samples.append(samples)
+                    out_messages.extend(packets)
+        if self.output_msgs:
+            parser.close()
+        del words
+        if handle_chunk is None:
+            self.out_raw = numpy.concatenate(out_raws).tolist()
+            if self.output_msgs:
+                self.out_samples = numpy.concatenate(out_samples).tolist()
+                self.out_messages = out_messages
+
+# The jobs being run by run_testbenches.  The pool is forked after this
+# is set so the workers get the testbenches without pickling them.
+_jobs = []
+
+# The attributes of a testbench that are set by running it.  They are
+# listed rather than matched by prefix since the MyHDL Signals (out_data,
+# out_nd, ...) cannot be pickled.
+result_attributes = ('out_raw', 'out_samples', 'out_messages', 'out_msgs',
+                     'out_ms', 'cycles_used', 'buffer_stats')
+# Set when a testbench is run with instrument=True.
+timing_attributes = ('in_cycles', 'out_cycles', 'timing')
+
+def _result_attributes(tb):
+    """
+    The attributes to copy back from a testbench run in the pool.
+    """
+    return dict([(k, tb.__dict__[k])
+                 for k in result_attributes + timing_attributes
+                 if k in tb.__dict__])
+
+def _run_job(index):
+    tb, clks, kwargs = _jobs[index]
+    try:
+        tb.run(clks, **kwargs)
+    except StandardError, e:
+        return None, e
+    return _result_attributes(tb), None
+
+def run_testbenches(jobs, processes=None, raise_errors=True):
+    """
+    Run many Icarus testbenches at once in a pool of processes.
+
+    Each job is run in a fresh process (with its own vvp and MyHDL
+    Simulation) and the output attributes (out_samples, out_messages,
+    out_raw, cycles_used, ...) are copied back onto the testbench
+    objects passed in.
+
+    TestBenchB100 jobs all use the same device so they should be run
+    one at a time instead.
+
+    Args:
+        jobs: A list of (testbench, clks) or (testbench, clks, kwargs)
+            tuples where kwargs is a dictionary of extra arguments for
+            the testbench's run method.
+        processes: The number of processes to use (defaults to the
+            number of CPUs).
+        raise_errors: Raise the first error from a testbench once all
+            the jobs have finished.  Otherwise the error (or None) is
+            just stored in each testbench's run_error.
+
+    Returns:
+        The list of testbenches.
+    """
+    global _jobs
+    _jobs = []
+    for job in jobs:
+        if len(job) == 2:
+            tb, clks = job
+            kwargs = {}
+        else:
+            tb, clks, kwargs = job
+        _jobs.append((tb, clks, kwargs))
+    if not _jobs:
+        return []
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    processes = min(processes, len(_jobs))
+    # One job per process since MyHDL keeps global simulation state.
+    pool = multiprocessing.Pool(processes, maxtasksperchild=1)
+    try:
+        results = [pool.apply_async(_run_job, (i,)) for i in range(len(_jobs))]
+        pool.close()
+        errors = []
+        for (tb, clks, kwargs), result in zip(_jobs, results):
+            attributes, error = result.get()
+            tb.run_error = error
+            if error is not None:
+                errors.append(error)
+                continue
+            for k, v in attributes.items():
+                setattr(tb, k, v)
+    finally:
+        pool.terminate()
+        pool.join()
+        testbenches = [job[0] for job in _jobs]
+        _jobs = []
+    if raise_errors and errors:
+        raise errors[0]
+    return testbenches
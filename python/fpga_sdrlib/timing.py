@@ -0,0 +1,109 @@
+# Copyright (c) 2012 Ben Reynwar
+# Released under MIT License (see LICENSE.txt)
+
+"""
+Throughput and latency of a module measured from the clock cycles at
+which samples went in (in_nd) and came out (out_nd) of a testbench.
+"""
+
+import json
+
+import numpy
+
+def percentile(xs, q):
+    if len(xs) == 0:
+        return None
+    return float(numpy.percentile(xs, q))
+
+class TimingReport(object):
+    """
+    Timing statistics for one testbench run.
+
+    The n'th sample out is paired with the n'th sample in to find the
+    latencies so this only makes sense for modules that produce one
+    output sample for each input sample.
+
+    Args:
+        in_cycles: The clock cycles at which samples were sent.
+        out_cycles: The clock cycles at which samples were received.
+        sendnth: The sendnth used for the run.
+        n_cycles: The number of clock cycles simulated.
+        name: A name for the report (e.g. the executable).
+        window: The number of outputs used to estimate min_sendnth.
+
+    Attributes:
+        latencies: Cycles between each input and its output.
+        samples_per_clock: Sustained output rate (between the first and
+            last outputs).
+        bubbles: How many gaps between outputs are longer than the
+            sendnth+1 cycles between inputs.
+        stall_cycles: The total length of those gaps beyond sendnth+1.
+        max_backlog: The most samples that were in the module at once.
+        min_sendnth: The smallest sendnth that the module was seen to
+            sustain over `window` consecutive outputs.  This is only
+            the true minimum if the module was running flat out.
+    """
+
+    def __init__(self, in_cycles, out_cycles, sendnth, n_cycles=None,
+                 name=None, window=16):
+        self.in_cycles = numpy.asarray(in_cycles, dtype=numpy.int64)
+        self.out_cycles = numpy.asarray(out_cycles, dtype=numpy.int64)
+        self.sendnth = sendnth
+        self.n_cycles = n_cycles
+        self.name = name
+        n_in = len(self.in_cycles)
+        n_out = len(self.out_cycles)
+        n = min(n_in, n_out)
+        self.latencies = self.out_cycles[:n] - self.in_cycles[:n]
+        if n_out > 1:
+            span = self.out_cycles[-1] - self.out_cycles[0]
+            self.samples_per_clock = float(n_out-1)/max(span, 1)
+        else:
+            self.samples_per_clock = 0.0
+        gaps = numpy.diff(self.out_cycles) - (sendnth+1)
+        self.bubbles = int(numpy.sum(gaps > 0))
+        self.stall_cycles = int(numpy.sum(gaps[gaps > 0]))
+        if n_out:
+            received = numpy.arange(1, n_out+1)
+            sent = numpy.searchsorted(self.in_cycles, self.out_cycles, 'right')
+            self.max_backlog = int(numpy.max(sent - received + 1))
+        else:
+            self.max_backlog = n_in
+        window = min(window, n_out-1)
+        if window > 0:
+            intervals = (self.out_cycles[window:] -
+                         self.out_cycles[:-window]) / float(window)
+            self.min_sendnth = max(int(numpy.ceil(intervals.min())) - 1, 0)
+        else:
+            self.min_sendnth = None
+
+    def to_dict(self):
+        return {
+            'name': self.name,
+            'sendnth': self.sendnth,
+            'n_cycles': self.n_cycles,
+            'n_in': len(self.in_cycles),
+            'n_out': len(self.out_cycles),
+            'latency': {
+                'min': percentile(self.latencies, 0),
+                'median': percentile(self.latencies, 50),
+                'p90': percentile(self.latencies, 90),
+                'p99': percentile(self.latencies, 99),
+                'max': percentile(self.latencies, 100),
+                'mean': (float(numpy.mean(self.latencies))
+                         if len(self.latencies) else None),
+                },
+            'samples_per_clock': self.samples_per_clock,
+            'bubbles': self.bubbles,
+            'stall_cycles': self.stall_cycles,
+            'max_backlog': self.max_backlog,
+            'min_sendnth': self.min_sendnth,
+            }
+
+    def write(self, fn):
+        """
+        Write the report to a JSON file.
+        """
+        f = open(fn, 'w')
+        json.dump(self.to_dict(), f, indent=2, sort_keys=True)
+        f.close()
@@ -6,6 +6,8 @@ from fpga_sdrlib.generate import copyfile
 
 blocks = {
     'dut_qa_wrapper.v': (None, copyfile, {}),
+    # Reads input from and writes output to files rather than myhdl.
+    'file_qa_wrapper.v': (None, copyfile, {}),
     'dut_qa_contents.v': (None, copyfile, {}),
     'qa_wrapper_null.v': (None, copyfile, {}),
     'bits.v': (None, copyfile, {}),
@@ -1,10 +1,19 @@
+import os
+import sys
 import random
 import logging
 import unittest
+import shutil
+import filecmp
+import tempfile
 
-from fpga_sdrlib import config, buildutils
+import numpy
+
+from fpga_sdrlib import config, buildutils, b100
 from fpga_sdrlib.testbench import TestBenchIcarusOuter, TestBenchB100
+from fpga_sdrlib.testbench import LoopbackTransport
 from fpga_sdrlib.generate import logceil
+from fpga_sdrlib.message import msg_utils
 
 def bits_to_int(bits):
     f = 1
@@ -14,6 +23,188 @@ def bits_to_int(bits):
         f *= 2
     return s
 
+class EchoTransport(object):
+    """
+    Stands in for a B100 running the null qa_wrapper by sending the words
+    straight back with some zeros either side.
+    """
+
+    def load_image(self, fpgaimage):
+        pass
+
+    def send(self, words):
+        self.words = words
+
+    def receive(self, n_receive, capture_fn=None):
+        received = numpy.zeros(n_receive, dtype=numpy.int32)
+        received[5: 5+len(self.words)] = self.words
+        if capture_fn is None:
+            return received.tolist()
+        received.tofile(capture_fn)
+
+class TestStreamingCapture(unittest.TestCase):
+
+    def setUp(self):
+        self.rg = random.Random(0)
+
+    def test_streaming(self):
+        """
+        Test that processing a capture a chunk at a time gives the same
+        result as processing it all at once.
+        """
+        data, packets = msg_utils.generate_random_packets(
+            20, 40, config.msg_length_width, config.msg_width, prob_start=0.5,
+            myrand=self.rg, none_sample=False)
+        whole = TestBenchB100(None, in_raw=data, transport=EchoTransport())
+        whole.run(2000)
+        self.assertEqual(whole.out_raw, data)
+        self.assertEqual(whole.out_messages, packets)
+        chunked = TestBenchB100(None, in_raw=data, transport=EchoTransport())
+        chunked.run(2000, streaming=True, chunk_size=7)
+        self.assertEqual(chunked.out_raw, data)
+        self.assertEqual(chunked.out_samples, whole.out_samples)
+        self.assertEqual(chunked.out_messages, packets)
+        # Chunks can be handled without keeping them.
+        n_words = []
+        def handle_chunk(out_raw, out_samples, out_messages):
+            n_words.append(len(out_raw))
+        handled = TestBenchB100(None, in_raw=data, transport=EchoTransport())
+        handled.run(2000, streaming=True, chunk_size=64,
+                    handle_chunk=handle_chunk)
+        self.assertEqual(sum(n_words), len(data))
+        self.assertTrue(max(n_words) <= 64)
+
+class TestLoopbackTransport(unittest.TestCase):
+
+    def setUp(self):
+        self.rg = random.Random(0)
+
+    def test_null(self):
+        """
+        Run the B100 testbench through an Icarus build of the null
+        qa_wrapper.
+        """
+        data, packets = msg_utils.generate_random_packets(
+            20, 40, config.msg_length_width, config.msg_width, prob_start=0.5,
+            myrand=self.rg, none_sample=False)
+        executable = buildutils.generate_icarus_executable(
+            'uhd', 'null', '-test', file_driven=True)
+        for streaming in (False, True):
+            transport = LoopbackTransport(executable)
+            tb = TestBenchB100(None, in_raw=data, transport=transport)
+            tb.run(len(data)+100, streaming=streaming)
+            self.assertEqual(tb.out_raw, data)
+            self.assertEqual(tb.out_messages, packets)
+
+# Stands in for the Xilinx build.  It writes an image into the build
+# directory of the makefile it is given and counts how often it is run.
+fake_make = """
+import os
+import sys
+
+make_fn = sys.argv[sys.argv.index('-f')+1]
+builddir, bn = os.path.split(make_fn)
+output_dir = os.path.join(builddir, bn.replace('Make.', 'build-', 1))
+os.makedirs(output_dir)
+f = open(os.path.join(output_dir, 'B100.bin'), 'w')
+f.write('image from ' + bn)
+f.close()
+f = open(os.path.join(os.path.dirname(sys.argv[0]), 'runs'), 'a')
+f.write(bn + '\\n')
+f.close()
+print('All constraints were met.')
+print('Done.')
+"""
+
+class TestImageStore(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix='image_store_')
+        self.make_fn = os.path.join(self.tmpdir, 'fake_make.py')
+        f = open(self.make_fn, 'w')
+        f.write(fake_make)
+        f.close()
+        self.old_b100dir = b100.b100dir
+        self.old_image_store_dir = b100.image_store_dir
+        b100.b100dir = self.tmpdir
+        b100.image_store_dir = os.path.join(self.tmpdir, 'store')
+        # Remove builds left by earlier runs so that they are not reused.
+        builddir = os.path.join(config.builddir, 'uhd')
+        for suffix in ('-store1', '-store2', '-store3'):
+            for prefix in ('build-B100_null', 'verilog-B100_null'):
+                dn = os.path.join(builddir, prefix + suffix)
+                if os.path.exists(dn):
+                    shutil.rmtree(dn)
+
+    def tearDown(self):
+        b100.b100dir = self.old_b100dir
+        b100.image_store_dir = self.old_image_store_dir
+        shutil.rmtree(self.tmpdir)
+
+    def runs(self):
+        fn = os.path.join(self.tmpdir, 'runs')
+        if not os.path.exists(fn):
+            return 0
+        f = open(fn)
+        n_runs = len(f.readlines())
+        f.close()
+        return n_runs
+
+    def test_store(self):
+        """
+        An image is only synthesised once for the same sources and defines.
+        """
+        command = [sys.executable, self.make_fn]
+        defines = config.updated_defines({'IMAGE_STORE_TEST': 1})
+        first = buildutils.generate_B100_image(
+            'uhd', 'null', '-store1', defines=defines, make_command=command)
+        self.assertEqual(self.runs(), 1)
+        # A different suffix has its own build directory so the image can
+        # only come from the store.
+        second = buildutils.generate_B100_image(
+            'uhd', 'null', '-store2', defines=defines, make_command=command)
+        self.assertEqual(self.runs(), 1)
+        self.assertNotEqual(first, second)
+        self.assertTrue(filecmp.cmp(first, second, shallow=False))
+        stored = os.listdir(b100.image_store_dir)
+        self.assertEqual(len(stored), 1)
+        self.assertEqual(sorted(os.listdir(os.path.join(b100.image_store_dir, stored[0]))),
+                         ['B100.bin', 'synthesis.log'])
+        # Changing a define needs a new image.
+        defines = config.updated_defines({'IMAGE_STORE_TEST': 2})
+        buildutils.generate_B100_image(
+            'uhd', 'null', '-store3', defines=defines, make_command=command)
+        self.assertEqual(self.runs(), 2)
+        self.assertEqual(len(os.listdir(b100.image_store_dir)), 2)
+
+    def test_store_image(self):
+        """
+        store_image copies through a temporary file and renames it.
+        """
+        image_fn = os.path.join(self.tmpdir, 'B100.bin')
+        log_fn = os.path.join(self.tmpdir, 'synthesis.log')
+        for fn in (image_fn, log_fn):
+            f = open(fn, 'w')
+            f.write(fn)
+            f.close()
+        renames = []
+        old_rename = os.rename
+        def rename(src, dst):
+            renames.append((os.path.dirname(src), os.path.basename(dst)))
+            old_rename(src, dst)
+        os.rename = rename
+        try:
+            stored_fn = b100.store_image('somekey', image_fn, log_fn)
+        finally:
+            os.rename = old_rename
+        store_dir = os.path.join(b100.image_store_dir, 'somekey')
+        self.assertEqual(renames, [(store_dir, 'synthesis.log'),
+                                   (store_dir, 'B100.bin')])
+        self.assertEqual(b100.stored_image('somekey'), stored_fn)
+        self.assertTrue(filecmp.cmp(stored_fn, image_fn, shallow=False))
+        # No temporary files are left behind.
+        self.assertEqual(sorted(os.listdir(store_dir)), ['B100.bin', 'synthesis.log'])
+
 class TestNull(unittest.TestCase):
     
     def setUp(self):
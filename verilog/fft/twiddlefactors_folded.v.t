@@ -0,0 +1,63 @@
+// -*- verilog -*-
+// Copyright (c) 2012 Ben Reynwar
+// Released under MIT License (see LICENSE.txt)
+
+// The same as twiddlefactors.v.t but only cos and sin for the first
+// eighth of a turn are stored.
+// The address is split into a region (which eighth of a turn) and an
+// offset.  For address k, Q=N/8, region=k/Q, r=k%Q:
+//   region 0: m=r   -> ( C[m], -S[m])
+//   region 1: m=Q-r -> ( S[m], -C[m])
+//   region 2: m=r   -> (-S[m], -C[m])
+//   region 3: m=Q-r -> (-C[m], -S[m])
+
+module twiddlefactors_{{N}} (
+    input  wire                            clk,
+    input  wire [{{log_N - 2}}:0]          addr,
+    input  wire                            addr_nd,
+    output wire signed [{{width-1}}:0] tf_out
+  );
+
+  wire [1:0]                        region;
+  wire [{{log_Q - 1}}:0]            r;
+  wire [{{log_Q}}:0]                m;
+  reg [1:0]                         region_z;
+  reg signed [{{width//2-1}}:0]     c;
+  reg signed [{{width//2-1}}:0]     s;
+  wire signed [{{width//2-1}}:0]    tf_re;
+  wire signed [{{width//2-1}}:0]    tf_im;
+
+  assign region = addr[{{log_N - 2}}:{{log_N - 3}}];
+  assign r = addr[{{log_Q - 1}}:0];
+  assign m = region[0] ? ({{log_Q+1}}'d{{Q}} - r) : r;
+
+  assign tf_re = (region_z == 2'd0) ? c :
+                 (region_z == 2'd1) ? s :
+                 (region_z == 2'd2) ? -s : -c;
+  assign tf_im = (region_z == 2'd0) ? -s :
+                 (region_z == 2'd1) ? -c :
+                 (region_z == 2'd2) ? -c : -s;
+  assign tf_out = {tf_re, tf_im};
+
+  always @ (posedge clk)
+    begin
+      if (addr_nd)
+        begin
+          region_z <= region;
+          case (m)
+			{% for tf in tfs %}
+            {{log_Q+1}}'d{{tf.i}}:
+              begin
+                c <= {{width//2}}'sd{{tf.c}};
+                s <= {{width//2}}'sd{{tf.s}};
+              end
+			{% endfor %}
+            default:
+              begin
+                c <= {{width//2}}'sd0;
+                s <= {{width//2}}'sd0;
+              end
+         endcase
+      end
+  end
+endmodule
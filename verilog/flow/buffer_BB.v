@@ -21,6 +21,13 @@ module buffer_BB
     // The current read data.
     output wire              read_full,
     output wire [WIDTH-1: 0] read_data,
+`ifdef DEBUG
+    // The most items that have been in the buffer at once.
+    output reg [31: 0]       high_water,
+    // The cycle (counting from 1 after reset) of the first overflow or
+    // 0 if there has not been one.
+    output reg [31: 0]       overflow_cycle,
+`endif
     // Buffer overflow.
     output wire               error
     );
@@ -56,6 +63,30 @@ module buffer_BB
 
    assign read_full = (read_delete)?read_full1:read_full0;
    assign read_data = (read_delete)?read_data1:read_data0;
+
+`ifdef DEBUG
+   // Occupancy statistics.  In simulation they are also appended to
+   // the file given by the +buffer_stats plusarg as lines
+   // '<instance> high_water <occupancy> <cycle>' and
+   // '<instance> overflow <cycle>'.
+   reg [31:0]                 occupancy;
+   reg [31:0]                 cycle;
+   wire                       write_ok;
+   wire                       delete_ok;
+   wire [31:0]                next_occupancy;
+   assign write_ok = write_strobe & !full[write_addr];
+   assign delete_ok = read_delete & full[read_addr0];
+   assign next_occupancy = occupancy + write_ok - delete_ok;
+`ifndef XILINX
+   reg [8*256-1:0]            stats_fn;
+   integer                    stats_fd;
+   initial
+     if ($value$plusargs("buffer_stats=%s", stats_fn))
+       stats_fd = $fopen(stats_fn, "a");
+     else
+       stats_fd = 0;
+`endif
+`endif
    
    always @(posedge clk)
      if (!rst_n)
@@ -65,9 +96,41 @@ module buffer_BB
           full <= {MEM_SIZE{1'b0}};
           write_addr <= {LOG_MEM_SIZE{1'b0}};
           read_addr0 <= {LOG_MEM_SIZE{1'b0}};
+`ifdef DEBUG
+          occupancy <= 32'd0;
+          cycle <= 32'd1;
+          high_water <= 32'd0;
+          overflow_cycle <= 32'd0;
+`endif
        end
      else
        begin
+`ifdef DEBUG
+          cycle <= cycle + 1;
+          occupancy <= next_occupancy;
+          if (next_occupancy > high_water)
+            begin
+               high_water <= next_occupancy;
+`ifndef XILINX
+               if (stats_fd)
+                 begin
+                    $fdisplay(stats_fd, "%m high_water %0d %0d", next_occupancy, cycle);
+                    $fflush(stats_fd);
+                 end
+`endif
+            end
+          if (write_strobe & !write_ok & (overflow_cycle == 32'd0))
+            begin
+               overflow_cycle <= cycle;
+`ifndef XILINX
+               if (stats_fd)
+                 begin
+                    $fdisplay(stats_fd, "%m overflow %0d", cycle);
+                    $fflush(stats_fd);
+                 end
+`endif
+            end
+`endif
           if (error)
             $display("There was an error");
           if (write_strobe)
@@ -0,0 +1,169 @@
+// Copyright (c) 2012 Ben Reynwar
+// Released under MIT License (see LICENSE.txt)
+
+// A wrapper around qa_wrapper that reads its input from a file and
+// writes its output to a file so that a simulation can run without
+// the myhdl test bench.
+//
+// Plusargs:
+//   +infile=<fn>   Each line is '<valid> <data>' in hex.  A line with
+//                  valid 0 is skipped without resetting the count (as
+//                  None is in the myhdl test bench).
+//   +outfile=<fn>  Each output is written on a line in hex.
+//   +sendnth=<n>   Input is sent every n+1 clock cycles.
+//   +clks=<n>      Maximum number of clock cycles to simulate.
+//   +n_outputs=<n> Stop once n outputs have been written.
+//   +count_samples Only count samples towards n_outputs (message
+//                  headers and their blocks are not counted).
+//   +idle_timeout=<n> Stop once all the input is sent and there has
+//                  been no output for n clock cycles.
+//   +cyclesfile=<fn> The number of clock cycles simulated is written here.
+//   +timingfile=<fn> A line 'i <cycle>' is written for each input and
+//                  'o <cycle>' for each output.
+
+module file_qa_wrapper;
+   reg                   clk;
+   reg                   reset;
+   reg [`WIDTH-1:0]      in_data;
+   reg                   in_nd;
+   wire [`WIDTH-1:0]     out_data;
+   wire                  out_nd;
+
+   reg [8*256-1:0]       infile;
+   reg [8*256-1:0]       outfile;
+   reg [8*256-1:0]       cyclesfile;
+   reg                   use_cyclesfile;
+   reg [8*256-1:0]       timingfile;
+   reg                   use_timingfile;
+   integer               timing_fd;
+   integer               n_outputs;
+   integer               idle_timeout;
+   integer               out_count;
+   reg                   count_samples;
+   integer               msg_blocks_left;
+   integer               last_active_cycle;
+   reg                   stop;
+   integer               in_fd;
+   integer               out_fd;
+   integer               sendnth;
+   integer               clks;
+   integer               count;
+   integer               cycle;
+   integer               n_read;
+   reg                   more_input;
+   reg                   valid;
+   reg [`WIDTH-1:0]      data;
+
+   qa_wrapper #(`WIDTH) dut
+     (clk, reset, in_data, in_nd, out_data, out_nd);
+
+   initial
+     begin
+        if (!$value$plusargs("infile=%s", infile))
+          begin
+             $display("No +infile given.");
+             $finish;
+          end
+        if (!$value$plusargs("outfile=%s", outfile))
+          begin
+             $display("No +outfile given.");
+             $finish;
+          end
+        if (!$value$plusargs("sendnth=%d", sendnth))
+          sendnth = 4;
+        if (!$value$plusargs("clks=%d", clks))
+          clks = 1000;
+        if (!$value$plusargs("n_outputs=%d", n_outputs))
+          n_outputs = -1;
+        if (!$value$plusargs("idle_timeout=%d", idle_timeout))
+          idle_timeout = -1;
+        count_samples = $test$plusargs("count_samples");
+        use_cyclesfile = $value$plusargs("cyclesfile=%s", cyclesfile);
+        use_timingfile = $value$plusargs("timingfile=%s", timingfile);
+        if (use_timingfile)
+          timing_fd = $fopen(timingfile, "w");
+        out_count = 0;
+        msg_blocks_left = 0;
+        last_active_cycle = 0;
+        in_fd = $fopen(infile, "r");
+        out_fd = $fopen(outfile, "w");
+        more_input = 1'b1;
+        count = 0;
+        cycle = 0;
+        clk = 1'b0;
+        reset = 1'b1;
+        in_nd = 1'b0;
+        in_data = {`WIDTH{1'b0}};
+     end
+
+   always #1 clk = ~clk;
+
+   always @ (posedge clk)
+     begin
+        cycle = cycle + 1;
+        // Record output.
+        if (out_nd)
+          begin
+             $fdisplay(out_fd, "%h", out_data);
+             if (!count_samples)
+               out_count = out_count + 1;
+             else if (msg_blocks_left > 0)
+               msg_blocks_left = msg_blocks_left - 1;
+             else if (out_data[`WIDTH-1])
+               msg_blocks_left = out_data[`WIDTH-2 -: `MSG_LENGTH_WIDTH];
+             else
+               out_count = out_count + 1;
+          end
+        if (use_timingfile)
+          begin
+             if (in_nd)
+               $fdisplay(timing_fd, "i %0d", cycle);
+             if (out_nd)
+               $fdisplay(timing_fd, "o %0d", cycle);
+          end
+        if (out_nd || more_input)
+          last_active_cycle = cycle;
+        if (cycle == 1)
+          reset <= 1'b1;
+        else
+          begin
+             reset <= 1'b0;
+             // Send input.
+             in_nd <= 1'b0;
+             if ((count >= sendnth) && more_input)
+               begin
+                  n_read = $fscanf(in_fd, "%h %h\n", valid, data);
+                  if (n_read != 2)
+                    more_input = 1'b0;
+                  else if (valid)
+                    begin
+                       in_data <= data;
+                       in_nd <= 1'b1;
+                       count = 0;
+                    end
+               end
+             else
+               count = count + 1;
+          end
+        stop = (cycle >= clks);
+        if ((n_outputs >= 0) && (out_count >= n_outputs))
+          stop = 1'b1;
+        if ((idle_timeout >= 0) && (cycle - last_active_cycle > idle_timeout))
+          stop = 1'b1;
+        if (stop)
+          begin
+             $fclose(out_fd);
+             $fclose(in_fd);
+             if (use_timingfile)
+               $fclose(timing_fd);
+             if (use_cyclesfile)
+               begin
+                  out_fd = $fopen(cyclesfile, "w");
+                  $fdisplay(out_fd, "%0d", cycle);
+                  $fclose(out_fd);
+               end
+             $finish;
+          end
+     end
+
+endmodule